@@ -4,32 +4,82 @@
 ## adaptor between generic code and scoring code specific
 ## to a given challenge question.
 ## Communication with R is through the RPy2 package.
+##
+## Engines are started the first time they're needed, so that
+## subcommands that don't validate or score start quickly. R is
+## started, and validate_and_score.R sourced, by r_engine(), and
+## email templates are read when they're first filled in.
+##
+## R can only be used by one thread at a time, so calls into it hold
+## r_lock. Native validation and scoring run concurrently.
 ############################################################
 
 
-import rpy2.robjects as robjects
 import synapseclient
 import math
+import metrics
+import native_scoring
+import native_validation
+import os
+import result_cache
+import submission_cache
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+## seconds taken to start each engine, for challenge.py --timings
+engine_timings = OrderedDict()
 
+## rpy2.robjects, once R has been started by r_engine()
+robjects = None
 
-# read in email templates
-with open("templates/confirmation_email.txt") as f:
-    validation_confirmation_template = unicode(f.read())
+## held by the thread using R
+r_lock = threading.RLock()
 
-with open("templates/validation_error_email.txt") as f:
-    validation_error_template = unicode(f.read())
 
-with open("templates/scored_email.txt") as f:
-    scored_template = unicode(f.read())
+def r_engine():
+    """
+    Start the embedded R interpreter and source validate_and_score.R,
+    if that hasn't been done yet, and return rpy2.robjects
+    """
+    global robjects
+    with r_lock:
+        if robjects is None:
+            started = time.time()
+            import rpy2.robjects as r_objects
+            r_objects.r('source("validate_and_score.R")')
+            robjects = r_objects
+            engine_timings['R'] = time.time() - started
+    return robjects
+
+
+class Template(object):
+    """
+    An email template, read from its file the first time it's filled in
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.text = None
 
-with open("templates/scored_final_email.txt") as f:
-    scored_final_template = unicode(f.read())
+    def format(self, *args, **kwargs):
+        if self.text is None:
+            started = time.time()
+            with open(self.path) as f:
+                self.text = unicode(f.read())
+            engine_timings['templates'] = engine_timings.get('templates', 0.0) + time.time() - started
+        return self.text.format(*args, **kwargs)
 
-with open("templates/scored_community_phase_email.txt") as f:
-    scored_community_phase_template = unicode(f.read())
 
-with open("templates/scoring_error_email.txt") as f:
-    scoring_error_template = unicode(f.read())
+# email templates
+validation_confirmation_template = Template("templates/confirmation_email.txt")
+validation_error_template = Template("templates/validation_error_email.txt")
+scored_template = Template("templates/scored_email.txt")
+scored_final_template = Template("templates/scored_final_email.txt")
+scored_community_phase_template = Template("templates/scored_community_phase_email.txt")
+scoring_error_template = Template("templates/scoring_error_email.txt")
 
 
 ## Configure scoring of evaluation queues
@@ -41,6 +91,12 @@ with open("templates/scoring_error_email.txt") as f:
 ## The scoring functions defined below (score_q1, score_q2, etc.) insert
 ## statistics onto the submission status annotations. Later, the 'fields'
 ## named in config_evaluations are used to compute mean ranking.
+##
+## By default, scoring functions are called in R. An evaluation with
+## 'scoring_engine': 'native' is instead scored by the function of the
+## same name in native_scoring.py, which avoids the R round trip.
+## Likewise, 'validation_engine': 'native' validates submissions with
+## the functions in native_validation.py.
 config_evaluations = [
 
     ## Q1
@@ -213,9 +269,6 @@ config_evaluations = [
 ]
 config_evaluations_map = {ev['id']:ev for ev in config_evaluations}
 
-robjects.r('source("validate_and_score.R")')
-r_mean_rank = robjects.r['mean_rank']
-
 output_templates = {
     "score_q1":
     "Submission scored.\n\n    Correlations are:\n" \
@@ -241,7 +294,7 @@ def as_dict(vector):
     """Convert an RPy2 ListVector to a Python dict"""
     result = {}
     for i, name in enumerate(vector.names):
-        if isinstance(vector[i], robjects.ListVector):
+        if isinstance(vector[i], r_engine().ListVector):
             result[name] = as_dict(vector[i])
         elif len(vector[i]) == 1:
             result[name] = vector[i][0]
@@ -250,18 +303,45 @@ def as_dict(vector):
     return result
 
 
+def result_key(config, kind, submission):
+    """
+    The result_cache key of validating, for kind 'validation', or scoring,
+    for kind 'scoring', a submission to the evaluation with the given config
+    """
+    reference = config['validation_expected_format' if kind == 'validation' else 'observed']
+    return result_cache.key(config[kind + '_function'], config.get(kind + '_engine', 'R'),
+                            submission.filePath, os.path.join(native_scoring.DATA_DIR, reference))
+
+
 def validate_submission(evaluation, submission, status):
     """
     To be called by challenge.py:validate()
     """
     config = config_evaluations_map[int(evaluation.id)]
 
-    ## get the R function that validates submissions for
-    ## this evaluation
-    r_validate_submission = robjects.r[config['validation_function']]
-
-    ## call an R function with signature: function(submission_path, expected_filename)
-    result = as_dict(r_validate_submission(submission.filePath, config['validation_expected_format']))
+    key = result_key(config, 'validation', submission)
+    result = result_cache.get(key)
+    if result is not None:
+        print "validated by an identical file"
+    elif config.get('validation_engine', 'R') == 'native':
+        native_validate_submission = getattr(native_validation, config['validation_function'])
+        with metrics.timed('validator', submission.id):
+            result = native_validate_submission(submission.filePath, config['validation_expected_format'])
+
+        ## keep the parsed submission on disk so it needn't be parsed again when scored
+        columns = native_scoring.parsed_submission(submission.filePath)
+        if result['valid'] and columns is not None:
+            submission_cache.save(submission.id, submission.filePath, columns)
+    else:
+        ## get the R function that validates submissions for
+        ## this evaluation
+        with r_lock:
+            r_validate_submission = r_engine().r[config['validation_function']]
+
+            ## call an R function with signature: function(submission_path, expected_filename)
+            with metrics.timed('validator', submission.id):
+                result = as_dict(r_validate_submission(submission.filePath, config['validation_expected_format']))
+    result_cache.put(key, result)
     print result
     status.status = "VALIDATED" if result['valid'] else "INVALID"
     return status, result['message']
@@ -275,19 +355,13 @@ correlation_keys = [
     "pearson_mmse",
     "ccc_mmse"]
 
-def score_submission(evaluation, submission, status):
+def add_scores_to_status(config, status, result):
     """
-    To be called by challenge.py:score()
+    Mark a status SCORED, add the scoring statistics in result to its
+    annotations and return it along with a message for the submitter
     """
-    config = config_evaluations_map[int(evaluation.id)]
-
-    ## get the R function that scores submissions for this
-    ## evaluation and a matching template for formatting the output
-    r_score_submission = robjects.r[config['scoring_function']]
     template = output_templates[config['scoring_function']]
 
-    ## call an R function with signature: function(submission_path, observed_path)
-    result = as_dict(r_score_submission(submission.filePath, config['observed']))
     ## change NANs to -99, because JSON is broken for NANs and -99 is
     ## outside the space of correlation values
     for key,value in result.iteritems():
@@ -303,17 +377,151 @@ def score_submission(evaluation, submission, status):
         annotations = {}
     annotations.update(result)
 
-    status.annotations = synapseclient.annotations.to_submission_status_annotations(annotations, is_private=False)
+    with metrics.timed('annotations', status.id):
+        status.annotations = synapseclient.annotations.to_submission_status_annotations(annotations, is_private=False)
     return status, (template).format(**annotations)
 
 
+def restore_parsed_submission(submission):
+    """
+    Hand a submission parsed during validation, possibly by an earlier
+    run, to native_scoring so that scoring doesn't parse it again
+    """
+    if native_scoring.parsed_submission(submission.filePath) is None:
+        columns = submission_cache.load(submission.id, submission.filePath)
+        if columns is not None:
+            native_scoring.store_parsed_submission(submission.filePath, columns)
+
+
+def score_submission(evaluation, submission, status):
+    """
+    To be called by challenge.py:score()
+    """
+    config = config_evaluations_map[int(evaluation.id)]
+
+    key = result_key(config, 'scoring', submission)
+    result = result_cache.get(key)
+    if result is not None:
+        print "scored by an identical file"
+    elif config.get('scoring_engine', 'R') == 'native':
+        restore_parsed_submission(submission)
+        native_score_submission = getattr(native_scoring, config['scoring_function'])
+        with metrics.timed('scorer', submission.id):
+            result = native_score_submission(submission.filePath, config['observed'])
+    else:
+        ## call an R function with signature: function(submission_path, observed_path)
+        with r_lock:
+            r_score_submission = r_engine().r[config['scoring_function']]
+            with metrics.timed('scorer', submission.id):
+                result = as_dict(r_score_submission(submission.filePath, config['observed']))
+    result_cache.put(key, result)
+
+    return add_scores_to_status(config, status, result)
+
+
+def score_submission_batch(evaluation, submissions, statuses):
+    """
+    To be called by challenge.py:score() with all the submissions to be
+    scored at once. Native engines score the batch in a handful of matrix
+    operations, R scores each submission in turn.
+
+    Returns a list holding a tuple (status, message, exc_info) for each
+    submission, where exc_info is None unless scoring raised an exception.
+    """
+    config = config_evaluations_map[int(evaluation.id)]
+
+    ## only submissions unlike any scored before go to the engine
+    keys = [result_key(config, 'scoring', submission) for submission in submissions]
+    results = [result_cache.get(key) for key in keys]
+    unscored = [i for i, result in enumerate(results) if result is None]
+    if len(unscored) < len(submissions):
+        print "%d submissions scored by identical files" % (len(submissions) - len(unscored))
+
+    if not unscored:
+        engine_results = []
+    elif config.get('scoring_engine', 'R') == 'native':
+        for i in unscored:
+            restore_parsed_submission(submissions[i])
+        native_score_batch = getattr(native_scoring, config['scoring_function'] + '_batch')
+        ## the batch is scored at once, so its time isn't counted against any one submission
+        with metrics.timed('scorer'):
+            engine_results = native_score_batch([submissions[i].filePath for i in unscored], config['observed'])
+    else:
+        with r_lock:
+            r_score_submission = r_engine().r[config['scoring_function']]
+        engine_results = []
+        for i in unscored:
+            try:
+                with r_lock, metrics.timed('scorer', submissions[i].id):
+                    engine_results.append((as_dict(r_score_submission(submissions[i].filePath, config['observed'])), None))
+            except Exception:
+                engine_results.append((None, sys.exc_info()))
+
+    for i, (result, exc_info) in zip(unscored, engine_results):
+        if not exc_info:
+            result_cache.put(keys[i], result)
+    results = [(result, None) for result in results]
+    for i, engine_result in zip(unscored, engine_results):
+        results[i] = engine_result
+
+    scored = []
+    for status, (result, exc_info) in zip(statuses, results):
+        if exc_info:
+            scored.append((status, None, exc_info))
+        else:
+            status, message = add_scores_to_status(config, status, result)
+            scored.append((status, message, None))
+    return scored
+
+
+def warm_engines(configs=config_evaluations):
+    """
+    Start the engines used by the given evaluation configurations and
+    load their observed data, so that the first submission to each isn't
+    slowed by it
+    """
+    started = time.time()
+    r_startup = engine_timings.get('R', 0.0)
+    for config in configs:
+        r_validation = config.get('validation_engine', 'R') != 'native'
+        r_scoring = config.get('scoring_engine', 'R') != 'native'
+        if r_validation or r_scoring:
+            r_engine()
+        if 'observed' in config:
+            if r_scoring:
+                with r_lock:
+                    r_engine().r['read_scoring_data'](config['observed'])
+            else:
+                native_scoring.read_scoring_data(config['observed'])
+    engine_timings['scoring data'] = time.time() - started - (engine_timings.get('R', 0.0) - r_startup)
+
+
+def invalidate_scoring_data(filename=None):
+    """
+    Drop cached observed and expected format data for one file or,
+    by default, all files, in both R and native_scoring
+    """
+    native_scoring.invalidate_scoring_data(filename)
+    ## R's cache is empty if R hasn't been started
+    if robjects is not None:
+        with r_lock:
+            robjects.r['invalidate_scoring_data'](filename if filename else robjects.NULL)
+
+
 def mean_rank(data):
-    ## convert to an R data frame
-    df = robjects.DataFrame({key:robjects.FloatVector(values) for key,values in data.iteritems()})
+    """
+    Mean and final rankings computed in R. challenge.py:rank() uses the
+    equivalent native_scoring.mean_rank, this is kept as a reference.
+    """
+    robjects = r_engine()
+
+    with r_lock:
+        ## convert to an R data frame
+        df = robjects.DataFrame({key:robjects.FloatVector(values) for key,values in data.iteritems()})
 
-    ## calculate the mean and final rankings
-    r_results = r_mean_rank(df)
+        ## calculate the mean and final rankings
+        r_results = robjects.r['mean_rank'](df)
 
-    return {name:col for name, col in r_results.items()}
+        return {name:col for name, col in r_results.items()}
 
 
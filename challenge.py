@@ -1,3 +1,7 @@
+## when the script started, for --timings
+import time
+STARTED = time.time()
+
 import synapseclient
 import synapseclient.utils as utils
 from synapseclient.exceptions import *
@@ -6,9 +10,11 @@ from synapseclient import Project, Folder, File
 from synapseclient import Evaluation, Submission, SubmissionStatus
 from synapseclient import Wiki
 
-from collections import OrderedDict
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from itertools import izip
+from itertools import imap, izip
+from multiprocessing.pool import ThreadPool
 from StringIO import StringIO
 
 ## TODO: show submission and evaluation info in error emails
@@ -18,25 +24,80 @@ from StringIO import StringIO
 ## import challenge specific validation and scoring and configuration
 import ad_challenge_scoring
 
+import claims
 import lock
+import metrics
+import native_scoring
+import outbox
+import profile_cache
+import quota
+import ranking
+import result_cache
+import submission_cache
+import submission_mirror
 import argparse
+import copy_reg
+import hashlib
 import json
 import math
+import multiprocessing
 import os
 import random
+import requests
+import signal
 import sys
-import time
+import threading
 import traceback
 import urllib
 import uuid
 
+IMPORTED = time.time()
 
 # how many submissions will be updated in a single batch
 BATCH_SIZE = 100
 
+# most submissions scored by one call of a batch scoring function, and
+# scored before their statuses are stored
+SCORING_CHUNK_SIZE = 20
+
 # how many times to we retry batch uploads of submission annotations
 BATCH_UPLOAD_RETRY_COUNT = 7
 
+# seconds to back off before the first retry of a batch upload, doubling
+# with each retry up to the maximum, randomized to spread out retries
+BATCH_UPLOAD_BACKOFF = 1.0
+BATCH_UPLOAD_MAX_BACKOFF = 60.0
+
+# beyond this many changed rankings, rank() lists scored submissions a
+# page at a time rather than fetching their statuses one at a time
+RANK_FETCH_THRESHOLD = 50
+
+# how many submissions are downloaded ahead of the one being worked on
+PREFETCH_COUNT = 8
+
+# how many threads download submissions
+DOWNLOAD_THREADS = 4
+
+# seconds to wait for a submission to download
+DOWNLOAD_TIMEOUT = 60 * 60
+
+# most requests to Synapse in flight at once, across all pipelines
+SYNAPSE_CONNECTIONS = 8
+
+# lease on an evaluation's lock, renewed while the run holding it makes
+# progress, so a run that dies gives up the lock this soon
+LOCK_LEASE = timedelta(minutes=1)
+
+# how many submissions a run claims at a time, when sharing evaluations
+# with runs on other hosts
+CLAIM_BATCH = 20
+
+# seconds between polls of an evaluation by serve, starting at the minimum
+# and multiplied by the backoff after each poll that finds nothing to do
+SERVE_MIN_INTERVAL = 15
+SERVE_MAX_INTERVAL = 10 * 60
+SERVE_BACKOFF = 2.0
+
 ADMIN_USER_IDS = [1421212]
 
 # TODO: quota configured per queue, Q1=100, Q2=50, Q3=50
@@ -45,35 +106,182 @@ SEND_VALIDATION_SUCCESS = False
 # module level variable to hold Synapse object
 syn = None
 
+# module level variable to hold the submission_mirror.SubmissionMirror from
+# which queues are read, or None to read them from Synapse
+mirror = None
+
+# outbox.Outbox through which messages about each evaluation are sent,
+# by evaluation ID. Messages about evaluations without one are sent right away.
+outboxes = {}
+
+# spaces out the messages sent through all outboxes
+message_rate_limiter = outbox.RateLimiter()
+
+# module level variable to hold the claims.ClaimStore through which
+# submissions are shared with runs on other hosts, or None to take them all
+claim_store = None
+
+# the evaluation locks held for the command being run, whose evaluations
+# are all worked on by this thread, see check_lock
+command_locks = []
+
+# fingerprints of statuses as fetched, by status ID, see fetch_submission_bundles
+status_fingerprints = {}
+
+# timing and retries of each batch uploaded by update_submissions_status_batch
+batch_upload_metrics = []
+
+# set when serve is asked to stop, see command_serve
+stop_requested = False
+
 
 ## read in email templates
 with open("templates/error_notification_email.txt") as f:
     error_notification_template = f.read()
 
 
+def report_timings(timings):
+    """
+    Print the seconds spent in each phase of a run, given an OrderedDict
+    of phase names and seconds
+    """
+    print "\nTimings:"
+    for phase, seconds in timings.iteritems():
+        print "    %-20s %8.3fs" % (phase, seconds)
+
+
+def check_lock(evaluation):
+    """
+    Report progress on an evaluation to its lock, if this run holds it,
+    so its lease is renewed. Raises lock.LockLostException if the lease
+    was lost to another run, which must be left to finish the work.
+    """
+    lock.progress(lock.evaluation_lock_name(evaluation.id))
+    ## a command holding several locks, like serve, works on their
+    ## evaluations one at a time, so progress on one is progress on all
+    for command_lock in command_locks:
+        command_lock.progress()
+
+
+def fingerprint_status(status):
+    """
+    Return a hash of the content of a SubmissionStatus, ignoring the
+    fields that Synapse changes on every update
+    """
+    content = {}
+    for key, value in status.iteritems():
+        if key in ('etag', 'modifiedOn', 'versionNumber'):
+            continue
+        if key == 'annotations':
+            value = {name: sorted(annotations, key=lambda annotation: annotation['key'])
+                           if isinstance(annotations, list) else annotations
+                     for name, annotations in value.iteritems()}
+        content[key] = value
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+
+def refresh_mirror(evaluation):
+    """
+    Bring the mirror of an evaluation, if there is one, up to date with
+    Synapse, once per pass over the evaluation
+    """
+    if mirror:
+        mirror.refresh(evaluation)
+
+
+def fetch_submission_bundles(evaluation, status=None):
+    """
+    Like syn.getSubmissionBundles, but reads from the mirror if there is
+    one, as of its last refresh, and fingerprints each status as it's fetched so that
+    update_submissions_status_batch can skip statuses that haven't changed.
+    The time spent fetching, not counting the caller's work between
+    bundles, is recorded as the getSubmissionBundles stage.
+    """
+    if mirror:
+        bundles = mirror.bundles(evaluation, status=status)
+    else:
+        bundles = syn.getSubmissionBundles(evaluation, status=status)
+    bundles = iter(bundles)
+    seconds = 0.0
+    try:
+        while True:
+            started = time.time()
+            try:
+                submission, submission_status = next(bundles)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.time() - started
+            status_fingerprints[submission_status.id] = (submission_status.etag, fingerprint_status(submission_status))
+            check_lock(evaluation)
+            yield submission, submission_status
+    finally:
+        metrics.record('getSubmissionBundles', seconds)
+
 
 def update_submissions_status_batch(evaluation, statuses):
-    for retry in range(BATCH_UPLOAD_RETRY_COUNT):
-        try:
-            token = None
-            offset = 0
-            while offset < len(statuses):
-                batch = {"statuses"     : statuses[offset:offset+BATCH_SIZE],
-                         "isFirstBatch" : (offset==0),
-                         "isLastBatch"  : (offset+BATCH_SIZE>=len(statuses)),
-                         "batchToken"   : token}
-                response = syn.restPUT("/evaluation/%s/statusBatch" % evaluation.id, json.dumps(batch))
-                token = response.get('nextUploadToken', None)
-                offset += BATCH_SIZE
-            ## finished batch uploading successfully
-            break
-        except SynapseHTTPError as err:
-            # on 412 ConflictingUpdateException we want to retry
-            if err.response.status_code == 412:
-                sys.stderr.write('%s, retrying...\n' % err.message)
-                time.sleep(2)
-            else:
-                raise
+    """
+    Upload statuses in batches, skipping statuses fetched by
+    fetch_submission_bundles whose content hasn't changed since.
+    Returns the number of statuses uploaded.
+
+    A batch that fails with a conflict is retried with backoff, after
+    refreshing its etags, without re-sending the batches before it.
+    Timing and retries of each batch are recorded in batch_upload_metrics.
+    """
+    changed = []
+    for status in statuses:
+        if status_fingerprints.get(status.id) != (status.etag, fingerprint_status(status)):
+            changed.append(status)
+    print "uploading %d statuses, skipping %d unchanged" % (len(changed), len(statuses) - len(changed))
+    statuses = changed
+
+    token = None
+    is_first_batch = True
+    offset = 0
+    while offset < len(statuses):
+        chunk = statuses[offset:offset+BATCH_SIZE]
+        check_lock(evaluation)
+        started = time.time()
+        for retry in range(BATCH_UPLOAD_RETRY_COUNT):
+            batch = {"statuses"     : chunk,
+                     "isFirstBatch" : is_first_batch,
+                     "isLastBatch"  : (offset+BATCH_SIZE>=len(statuses)),
+                     "batchToken"   : token}
+            try:
+                with metrics.timed('update_submissions_status_batch'):
+                    response = syn.restPUT("/evaluation/%s/statusBatch" % evaluation.id, json.dumps(batch))
+                break
+            except SynapseHTTPError as err:
+                # on 412 ConflictingUpdateException we want to retry
+                if err.response.status_code != 412 or retry == BATCH_UPLOAD_RETRY_COUNT-1:
+                    raise
+                delay = random.uniform(0, min(BATCH_UPLOAD_MAX_BACKOFF, BATCH_UPLOAD_BACKOFF * 2**retry))
+                sys.stderr.write('%s, retrying batch at offset %d in %.1f seconds...\n' % (err.message, offset, delay))
+                time.sleep(delay)
+                ## batches before this one were committed, so start a new series
+                ## of batches here, with fresh etags for this batch only
+                for status in chunk:
+                    status.etag = syn.getSubmissionStatus(status.id).etag
+                is_first_batch = True
+                token = None
+
+        batch_upload_metrics.append({'evaluation': evaluation.id,
+                                     'offset': offset,
+                                     'statuses': len(chunk),
+                                     'seconds': time.time() - started,
+                                     'retries': retry})
+        ## the fetched etags of uploaded statuses are now stale
+        for status in chunk:
+            status_fingerprints.pop(status.id, None)
+        if mirror:
+            mirror.invalidate(status.id for status in chunk)
+
+        token = response.get('nextUploadToken', None)
+        is_first_batch = False
+        offset += BATCH_SIZE
+
+    return len(statuses)
 
 
 def get_status_annotations_as_dictionary(status):
@@ -102,14 +310,68 @@ def add_team_annotation(submission, status):
     if 'submitterAlias' in submission and submission.submitterAlias:
         annotations['team'] = submission.submitterAlias
     else:
-        profile = syn.getUserProfile(submission.userId)
+        profile = profile_cache.get_user_profile(syn, submission.userId)
         annotations['team'] = get_user_name(profile)
     status.annotations = synapseclient.annotations.to_submission_status_annotations(annotations, is_private=False)
     return status
 
 
-def send_message(template, submission, status, evaluation, message):
-    profile = syn.getUserProfile(submission.userId)
+def open_outbox(evaluation_id):
+    """
+    Open the outbox of an evaluation, whose lock must be held
+    """
+    outboxes[unicode(evaluation_id)] = outbox.Outbox(
+        syn, dir=os.path.join(outbox.OUTBOX_DIR, unicode(evaluation_id)), rate_limiter=message_rate_limiter,
+        retention=submission_mirror.FULL_REFRESH_SECONDS)
+
+
+def close_outbox(evaluation_id):
+    """
+    Send the messages left in an evaluation's outbox and close it,
+    before its lock is released
+    """
+    message_outbox = outboxes.pop(unicode(evaluation_id), None)
+    if message_outbox:
+        message_outbox.close()
+
+
+def queue_message(key, user_ids, subject, body, evaluation=None):
+    """
+    Send a message through the evaluation's outbox or, if there isn't
+    one, right away. A message is only queued once for each key, but
+    may be sent again if a run dies before marking it delivered.
+    """
+    message_outbox = outboxes.get(unicode(evaluation.id)) if evaluation else None
+    if message_outbox:
+        if message_outbox.enqueue(key, user_ids, subject, body):
+            print "queued message: ", key
+        else:
+            print "message already sent: ", key
+    else:
+        with metrics.timed('send_message'):
+            response = syn.sendMessage(
+                userIds=user_ids,
+                messageSubject=subject,
+                messageBody=body)
+        print "sent message: ", unicode(response).encode('utf-8')
+
+
+def message_key(submission, status, kind):
+    """
+    A key for a message about a submission, from the submission, the
+    status it was given and the kind of message. It leaves out the etag,
+    which changes whenever the status is stored, as claiming does.
+    """
+    return "%s.%s.%s" % (submission.id, status.status, kind)
+
+
+def send_message(template, submission, status, evaluation, message, key=None):
+    with metrics.timed('send_message', submission.id):
+        _send_message(template, submission, status, evaluation, message, key)
+
+
+def _send_message(template, submission, status, evaluation, message, key=None):
+    profile = profile_cache.get_user_profile(syn, submission.userId)
 
     #print "sending message to %s" % submission.userId
 
@@ -123,10 +385,107 @@ def send_message(template, submission, status, evaluation, message):
         team=unicode(submission.get('submitterAlias', 'no team specified')),
         message=unicode(message))
 
-    return syn.sendMessage(
-        userIds=[submission.userId],
-        messageSubject="Submission to %s, %s" % (evaluation.name, status),
-        messageBody=message_body)
+    queue_message(key or unicode(uuid.uuid4()),
+                  [submission.userId],
+                  "Submission to %s, %s" % (evaluation.name, status),
+                  message_body,
+                  evaluation=evaluation)
+
+
+def claim_key(evaluation, user_id):
+    """
+    The key under which a user's submissions to an evaluation are claimed
+    """
+    return "%s/%s" % (evaluation.id, user_id)
+
+
+def claim_bundles(evaluation, bundles, limit=None):
+    """
+    Return the (submission, status) bundles claimed by this run, in order,
+    skipping those of users claimed by other runs. Each user's bundles are
+    claimed together, until limit bundles are claimed. Without a claim
+    store, all the bundles are returned.
+    """
+    if not claim_store:
+        return bundles
+    by_user = OrderedDict()
+    for submission, status in bundles:
+        by_user.setdefault(submission.userId, []).append(status)
+    claimed = {}
+    for user_id, statuses in by_user.iteritems():
+        if limit and len(claimed) >= limit:
+            break
+        claimed_statuses = claim_store.claim_statuses(claim_key(evaluation, user_id), statuses)
+        if claimed_statuses is None:
+            continue
+        for status, claimed_status in izip(statuses, claimed_statuses):
+            if claimed_status is not status and mirror:
+                mirror.put_status(claimed_status)
+            claimed[status.id] = claimed_status
+    return [(submission, claimed[status.id]) for submission, status in bundles if status.id in claimed]
+
+
+def release_claims(evaluation, bundles):
+    if claim_store:
+        for user_id in set(submission.userId for submission, status in bundles):
+            claim_store.release(claim_key(evaluation, user_id))
+
+
+def chunks(items, size):
+    """
+    Yield lists of up to size items, in order, taking them from items as
+    each list is wanted
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _download(submission):
+    with metrics.timed('getSubmission', submission.id):
+        return syn.getSubmission(submission)
+
+
+def prefetch_submissions(bundles, skip=None, prefetch=PREFETCH_COUNT, threads=DOWNLOAD_THREADS, progress=None):
+    """
+    Yield (submission, status) bundles in order, with each submission
+    refetched so that we get the file path. Up to prefetch submissions
+    ahead of the one being worked on are downloaded by a pool of threads.
+    Submissions for which skip(submission) is true aren't refetched. If
+    a download fails or the caller stops early, pending downloads are
+    abandoned. progress() is called as each download is handed on.
+    """
+    pool = ThreadPool(threads)
+    pending = deque()
+    try:
+        for submission, status in bundles:
+            if skip and skip(submission):
+                pending.append((None, submission, status))
+            else:
+                pending.append((pool.apply_async(_download, (submission,)), submission, status))
+            while len(pending) > prefetch:
+                download, submission, status = pending.popleft()
+                submission = download.get(DOWNLOAD_TIMEOUT) if download else submission
+                if progress:
+                    progress()
+                yield submission, status
+        while pending:
+            download, submission, status = pending.popleft()
+            submission = download.get(DOWNLOAD_TIMEOUT) if download else submission
+            if progress:
+                progress()
+            yield submission, status
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 
 def validate_submission(submission, status):
@@ -134,219 +493,501 @@ def validate_submission(submission, status):
     return status, "OK"
 
 
+def _dict_object(cls, content):
+    return cls(**content)
+
+def _reduce_dict_object(obj):
+    ## a DictObject is its own __dict__, which pickling splits in two, so
+    ## that attributes set in a worker process wouldn't reach the dict
+    return _dict_object, (type(obj), dict(obj))
+
+copy_reg.pickle(Submission, _reduce_dict_object)
+copy_reg.pickle(SubmissionStatus, _reduce_dict_object)
+
+
+def _init_worker():
+    ## leave Ctrl-C to the parent process, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ## and don't inherit serve's handler, so the pool can be terminated
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    ## the pool was forked holding the locks of state shared between
+    ## pipelines, see _map, which may be held by threads that weren't forked
+    ad_challenge_scoring.r_lock = threading.RLock()
+    native_scoring.cache_lock = threading.RLock()
+    result_cache.results_lock = threading.Lock()
+    metrics.timings_lock = threading.Lock()
+    ## timings inherited from the parent are the parent's to write
+    metrics.drain()
+
+
+def _call_and_drain(func_and_task):
+    """
+    Call func on task in a worker process, returning the result along
+    with the timings recorded meanwhile, for the parent to merge
+    """
+    func, task = func_and_task
+    result = func(task)
+    return result, metrics.drain()
+
+
+def _map(func, tasks, workers=1):
+    """
+    Map func over tasks, yielding results in order. With more than one
+    worker, tasks are farmed out to a pool of processes, each of which
+    keeps its validation and scoring engines warm between tasks. With
+    one worker, tasks are mapped lazily in this process.
+    """
+    if workers <= 1:
+        for result in imap(func, tasks):
+            yield result
+        return
+
+    tasks = list(tasks)
+    ## fork while no other pipeline is in R or changing the caches, so
+    ## workers get them in a usable state. The locks are taken in the
+    ## order they're nested elsewhere: R calls record timings.
+    fork_locks = [ad_challenge_scoring.r_lock, native_scoring.cache_lock,
+                  result_cache.results_lock, metrics.timings_lock]
+    for fork_lock in fork_locks:
+        fork_lock.acquire()
+    try:
+        pool = multiprocessing.Pool(max(1, min(workers, len(tasks))), initializer=_init_worker)
+    finally:
+        for fork_lock in reversed(fork_locks):
+            fork_lock.release()
+    try:
+        for result, timings in pool.imap(_call_and_drain, ((func, task) for task in tasks)):
+            metrics.merge(timings)
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _validate_one(task):
+    """
+    Validate one submission, possibly in a worker process. Errors are
+    returned as formatted tracebacks, since tracebacks can't be pickled.
+    """
+    if task is None:
+        return None
+    validation_func, evaluation, submission, status = task
+    try:
+        status, validation_message = validation_func(evaluation, submission, status)
+        return submission, status, validation_message, None
+    except Exception as ex1:
+        return submission, status, None, traceback.format_exc()
+
+
 def validate(evaluation,
              validation_func=validate_submission,
              send_messages=False,
              notifications=False,
              dry_run=False,
              submission_quota=None,
-             config={}):
+             config={},
+             workers=1,
+             claim_limit=None):
     """
     It may be convenient to validate submissions in one pass before scoring
     them, especially if scoring takes a long time.
+
+    With workers > 1, submissions are validated in that many processes.
+    Quotas, status updates and messages are still handled here, in order.
+
+    With a claim store, only submissions this run claims are validated,
+    those of users making up about claim_limit of them.
     """
     sys.stdout.write('\n\n' + '-' * 60 + '\n')
     sys.stdout.write('validating evaluation: %s %s\n' % (evaluation.id, evaluation.name))
     sys.stdout.flush()
 
-    submission_counts_by_user = count_submissions_by_user(evaluation, status='SCORED')
+    bundles = claim_bundles(evaluation, list(fetch_submission_bundles(evaluation, status='RECEIVED')), claim_limit)
+
+    ## counted once the users are claimed, so no other run is validating
+    ## or scoring their submissions. Those validated and waiting to be
+    ## scored, perhaps by another run, count against the quota too.
+    submission_counts = get_quota(evaluation, submission_quota, statuses=('SCORED', 'VALIDATED'))
+
+    def over_quota(submission):
+        return submission_counts.exceeded(submission.userId)
 
     count = 0
 
-    for submission, status in syn.getSubmissionBundles(evaluation, status='RECEIVED'):
+    if send_messages:
+        profile_cache.prefetch(syn, set(submission.userId for submission, status in bundles))
+
+    ## Submissions whose users are at quota aren't downloaded or validated.
+    ## Downloads and worker processes run ahead of the loop below, seeing
+    ## counts that may be out of date, so quota is checked again, in order,
+    ## as submissions are validated.
+    tasks = (None if over_quota(submission) else (validation_func, evaluation, submission, status)
+             for submission, status in prefetch_submissions(bundles, skip=over_quota,
+                                                            progress=lambda: check_lock(evaluation)))
+
+    for (submission, status), result in izip(bundles, _map(_validate_one, tasks, workers)):
 
         sys.stdout.write('\nvalidating submission: %s %s\n' % (submission.id, submission.name))
         sys.stdout.flush()
 
         count += 1
+        check_lock(evaluation)
 
-        if submission_quota and submission_counts_by_user.get(submission.userId, 0) >= submission_quota:
+        if over_quota(submission):
             status.status = "INVALID"
-            validation_message = "You have reached the submission quota. You have submitted %d entries out of a maximum of %d allowed." % (submission_counts_by_user.get(submission.userId, 0), submission_quota)
+            validation_message = "You have reached the submission quota. You have submitted %d entries out of a maximum of %d allowed." % (submission_counts.count(submission.userId), submission_quota)
             print validation_message.encode('utf-8')
 
         else:
-            ## refetch the submission so that we get the file path
-            ## to be later replaced by a "downloadFiles" flag on getSubmissionBundles
-            submission = syn.getSubmission(submission)
-
-            try:
-                status, validation_message = validation_func(evaluation, submission, status)
-            except Exception as ex1:
+            submission, status, validation_message, error = result
+            if error:
                 sys.stderr.write('Error validating submission %s %s:\n' % (submission.name, submission.id))
-                st = StringIO()
-                traceback.print_exc(file=st)
-                sys.stderr.write(st.getvalue())
+                sys.stderr.write(error)
                 sys.stderr.write('\n')
                 status.status = "INVALID"
-                validation_message = st.getvalue()
+                validation_message = error
+
+        ## queue messages BEFORE storing the status, so a run that dies in
+        ## between doesn't lose them. Their keys hold the submission and its new
+        ## status, so the rerun that stores the status doesn't repeat them.
+        if send_messages:
+            template = config.get("validation_confirmation_template" if status.status=="VALIDATED" else "validation_error_template", None)
+            if template:
+                send_message(template, submission, status.status, evaluation, validation_message,
+                             key=message_key(submission, status, 'validation'))
+
+        if notifications and status.status=="INVALID":
+            queue_message(message_key(submission, status, 'validation-notification'),
+                          ADMIN_USER_IDS,
+                          "AD Challenge exception during validation",
+                          error_notification_template.format(message=unicode(validation_message)),
+                          evaluation=evaluation)
 
         if not dry_run:
-            syn.store(status)
+            ## a VALIDATED status keeps any claim held in it, for scoring
+            if status.status=="INVALID":
+                claims.remove_claim(status)
+            stored_status = syn.store(status)
+            if mirror:
+                mirror.put_status(stored_status)
+            ## parsed submissions are only needed until they're scored
+            if status.status=="INVALID":
+                submission_cache.evict(submission.id)
 
         ## keep track of user's submission counts as we go
         if status.status=="VALIDATED":
-            submission_counts_by_user.setdefault(submission.userId, 0)
-            submission_counts_by_user[submission.userId] += 1
+            submission_counts.add(submission.userId)
 
         print submission.id, submission.name.encode('utf-8'), submission.userId, status.status
 
-        ## send message AFTER storing status to ensure we don't get repeat messages
-        if send_messages:
-            template = config.get("validation_confirmation_template" if status.status=="VALIDATED" else "validation_error_template", None)
-            if template:
-                response = send_message(template, submission, status.status, evaluation, validation_message)
-                print "sent message: ", unicode(response).encode('utf-8')
-
-        if notifications and status.status=="INVALID":
-            response = syn.sendMessage(
-                userIds=ADMIN_USER_IDS,
-                messageSubject="AD Challenge exception during validation",
-                messageBody=error_notification_template.format(message=unicode(validation_message)))
-            print "sent notification: ", unicode(response).encode('utf-8')
+    release_claims(evaluation, bundles)
 
     print "\nvalidated %d submissions." % count
     print '-' * 60 + '\n'
 
+    return count
+
 
 def score_submission(submission, status):
     status.status = "SCORED"
     return status, "OK"
 
 
+def _score_one(task):
+    """
+    Score one submission, possibly in a worker process
+    """
+    scoring_func, evaluation, submission, status = task
+    try:
+        status, msg = scoring_func(evaluation, submission, status)
+        return submission, status, msg, None
+    except Exception as ex1:
+        return submission, status, None, traceback.format_exc()
+
+
+def _score_chunk(task):
+    """
+    Score a chunk of submissions with a batch scoring function, possibly
+    in a worker process
+    """
+    batch_scoring_func, evaluation, submissions, statuses = task
+    return [(submission, status, msg, ''.join(traceback.format_exception(*exc_info)) if exc_info else None)
+            for submission, (status, msg, exc_info) in izip(submissions, batch_scoring_func(evaluation, submissions, statuses))]
+
+
 def score(evaluation,
           scoring_func=score_submission,
+          batch_scoring_func=None,
           send_messages=False,
           notifications=False,
           dry_run=False,
           submission_quota=None,
-          config={}):
+          config={},
+          workers=1,
+          claim_limit=None):
+    """
+    Score all VALIDATED submissions to an evaluation. If batch_scoring_func
+    is given, it's called with chunks of up to SCORING_CHUNK_SIZE
+    submissions, otherwise scoring_func is called for each submission.
+    Statuses are stored, and messages queued, a chunk at a time.
+
+    With workers > 1, submissions are scored in that many processes,
+    sharing out the chunks. Submission numbers, messages and the status
+    upload are still handled here, in order.
 
+    With a claim store, only submissions this run claims are scored,
+    those of users making up about claim_limit of them.
+    """
     sys.stdout.write('\n\n' + '-' * 60 + '\n')
     sys.stdout.write('scoring evaluation: %s %s\n' % (evaluation.id, evaluation.name))
     sys.stdout.flush()
 
-    ## collect statuses here for batch update
+    claimed = claim_bundles(evaluation, list(fetch_submission_bundles(evaluation, status='VALIDATED')), claim_limit)
+
+    ## counted once the users are claimed, so their submissions are numbered by this run alone
+    submission_counts = get_quota(evaluation, submission_quota)
+
+    ## fetch profiles, for team names and messages, in one request up front
+    profile_cache.prefetch(syn, set(submission.userId for submission, status in claimed
+                                    if send_messages or not submission.get('submitterAlias', None)))
+
+    ## submissions are scored one at a time as they're downloaded, while
+    ## batches wait for the submissions in their chunk
+    bundles = prefetch_submissions(claimed, progress=lambda: check_lock(evaluation))
+
+    ## an equal share for each worker, if that's smaller than a chunk
+    chunk_size = max(1, min(SCORING_CHUNK_SIZE, int(math.ceil(len(claimed) / float(max(1, workers))))))
+
+    if batch_scoring_func:
+        tasks = ((batch_scoring_func, evaluation,
+                  [submission for submission, status in chunk],
+                  [status for submission, status in chunk])
+                 for chunk in chunks(bundles, chunk_size))
+        results = (result for chunk_results in _map(_score_chunk, tasks, workers) for result in chunk_results)
+    else:
+        results = _map(_score_one, ((scoring_func, evaluation, submission, status) for submission, status in bundles), workers)
+
+    ## the statuses of a chunk, stored once it's scored
     statuses = []
     submissions = []
     messages = []
+    count = 0
+
+    def store_chunk():
+        ## queue messages BEFORE the upload, so a run that dies in between doesn't
+        ## lose them. Their keys hold the submissions and their new statuses, so
+        ## the rerun that uploads the statuses doesn't repeat them.
+        if send_messages:
+            for submission, status, message in izip(submissions, statuses, messages):
+                template = config["scored_template" if status.status=="SCORED" else "scoring_error_template"]
+                send_message(template, submission, status.status, evaluation, message,
+                             key=message_key(submission, status, 'scoring'))
+
+        ## Update statuses in batch. This can be much faster than individual updates,
+        ## especially in rank based scoring methods which recalculate scores for all
+        ## submissions each time a new submission is received.
+        if not dry_run:
+            update_submissions_status_batch(evaluation, statuses)
+            for submission in submissions:
+                submission_cache.evict(submission.id)
 
-    submission_counts_by_user = count_submissions_by_user(evaluation, status='SCORED')
+        del statuses[:], submissions[:], messages[:]
 
-    for submission, status in syn.getSubmissionBundles(evaluation, status='VALIDATED'):
+    for submission, status, msg, error in results:
+        check_lock(evaluation)
 
         sys.stdout.write('\nscoring submission: %s %s\n' % (submission.id, submission.name))
         sys.stdout.flush()
 
-        ## refetch the submission so that we get the file path
-        ## to be later replaced by a "downloadFiles" flag on getSubmissionBundles
-        submission = syn.getSubmission(submission)
-
-        try:
-            status, msg = scoring_func(evaluation, submission, status)
-
-            ## keep track of user's submission counts as we go
-            submission_counts_by_user.setdefault(submission.userId, 0)
-            submission_counts_by_user[submission.userId] += 1
+        ## scoring releases any claim held in the status, SCORED or INVALID
+        claims.remove_claim(status)
 
-            annotations = synapseclient.annotations.from_submission_status_annotations(status.annotations)
-            annotations['submission_number'] = submission_counts_by_user[submission.userId]
-            ## add team annotation to submissions
-            if 'submitterAlias' in submission and submission.submitterAlias:
-                annotations['team'] = submission.submitterAlias
-            else:
-                profile = syn.getUserProfile(submission.userId)
-                annotations['team'] = get_user_name(profile)
-            status.annotations = synapseclient.annotations.to_submission_status_annotations(annotations, is_private=False)
-
-            if submission_quota:
-                msg += "\nThis is your %s submission out of a maximum of %d allowed." % (
-                        to_ordinal(submission_counts_by_user[submission.userId]), submission_quota)
+        if not error:
+            try:
+                ## keep track of user's submission counts as we go
+                submission_number = submission_counts.add(submission.userId)
+
+                annotations = synapseclient.annotations.from_submission_status_annotations(status.annotations)
+                annotations['submission_number'] = submission_number
+                ## add team annotation to submissions
+                if 'submitterAlias' in submission and submission.submitterAlias:
+                    annotations['team'] = submission.submitterAlias
+                else:
+                    profile = profile_cache.get_user_profile(syn, submission.userId)
+                    annotations['team'] = get_user_name(profile)
+                with metrics.timed('annotations', submission.id):
+                    status.annotations = synapseclient.annotations.to_submission_status_annotations(annotations, is_private=False)
+
+                if submission_quota:
+                    msg += "\nThis is your %s submission out of a maximum of %d allowed." % (
+                            to_ordinal(submission_number), submission_quota)
+
+                messages.append(msg)
+            except Exception as ex1:
+                error = traceback.format_exc()
 
-            messages.append(msg)
-        except Exception as ex1:
+        if error:
             sys.stderr.write('Error scoring submission %s %s:\n' % (submission.name, submission.id))
-            st = StringIO()
-            traceback.print_exc(file=st)
-            sys.stderr.write(st.getvalue())
+            sys.stderr.write(error)
             sys.stderr.write('\n')
             status.status = "INVALID"
-            messages.append(st.getvalue())
+            messages.append(error)
 
             if notifications:
-                response = syn.sendMessage(
-                    userIds=ADMIN_USER_IDS,
-                    messageSubject="AD Challenge: exception during scoring",
-                    messageBody=error_notification_template.format(message=st.getvalue()))
-                print "sent notification: ", unicode(response).encode('utf-8')
+                queue_message(message_key(submission, status, 'scoring-notification'),
+                              ADMIN_USER_IDS,
+                              "AD Challenge: exception during scoring",
+                              error_notification_template.format(message=error),
+                              evaluation=evaluation)
 
         ## we could store each status update individually, but in this example
         ## we collect the updated status objects to do a batch update.
         #status = syn.store(status)
         statuses.append(status)
         submissions.append(submission)
+        count += 1
 
         print submission.id, submission.name.encode('utf-8'), submission.userId, status.status
 
-    ## Update statuses in batch. This can be much faster than individual updates,
-    ## especially in rank based scoring methods which recalculate scores for all
-    ## submissions each time a new submission is received.
-    if not dry_run:
-        update_submissions_status_batch(evaluation, statuses)
+        if len(statuses) >= chunk_size:
+            store_chunk()
 
-    if send_messages:
-        for submission, status, message in izip(submissions, statuses, messages):
-            template = config["scored_template" if status.status=="SCORED" else "scoring_error_template"]
-            response = send_message(template, submission, status.status, evaluation, message)
-            print "sent message: ", unicode(response).encode('utf-8')
+    if statuses:
+        store_chunk()
 
+    release_claims(evaluation, claimed)
 
-    print "\nscored %d submissions." % len(submissions)
+    print "\nscored %d submissions." % count
     print '-' * 60 + '\n'
 
-    return len(submissions)
+    return count
 
 
-def rank(evaluation, fields=[], dry_run=False):
+def query_ranking_inputs(evaluation, fields):
+    """
+    Fetch the fields to be ranked and the current rankings of all SCORED
+    submissions from the submission query service, which returns only
+    the columns asked for. Returns a tuple (ids, modified_on, scores, rankings)
+    where modified_on maps IDs to modification times, scores is an
+    OrderedDict holding an array of floats for each field, in the order
+    of ids, and rankings maps IDs to (mean_rank, final_rank) where present.
+    """
+    ids = []
+    modified_on = {}
+    scores = OrderedDict((field, array('d')) for field in fields)
+    rankings = {}
+
+    def to_float(value):
+        return float('nan') if value is None or value == '' else float(value)
+
+    columns = ['objectId', 'modifiedOn'] + list(fields) + ['mean_rank', 'final_rank']
+    for result in submission_mirror.query(syn, 'select %s from evaluation_%s where status == "SCORED"' % (
+            ', '.join(columns), evaluation.id)):
+        check_lock(evaluation)
+        status_id = result['objectId']
+        ids.append(status_id)
+        modified_on[status_id] = long(result['modifiedOn'])
+        for field in fields:
+            scores[field].append(to_float(result.get(field, None)))
+        if result.get('mean_rank', None) not in (None, '') and result.get('final_rank', None) not in (None, ''):
+            rankings[status_id] = (float(result['mean_rank']), float(result['final_rank']))
 
-    sys.stdout.write('ranking evaluation: %s %s\n' % (evaluation.id, evaluation.name))
-    sys.stdout.flush()
+    return ids, modified_on, scores, rankings
 
-    ## initialize columns to hold scoring statistics
-    data = OrderedDict()
-    for field in fields:
-        data[field] = []
 
-    statuses = []
+def bundle_ranking_inputs(evaluation, fields, statuses=None):
+    """
+    Like query_ranking_inputs, but reading the annotations of SCORED
+    bundles. If statuses is given, the statuses read are added to it by ID.
+    """
+    ids = []
+    modified_on = {}
+    scores = OrderedDict((field, array('d')) for field in fields)
+    rankings = {}
 
-    ## extract the scoring statistics from each scored submission
-    for submission, status in syn.getSubmissionBundles(evaluation, status='SCORED'):
-        statuses.append(status)
+    for submission, status in fetch_submission_bundles(evaluation, status='SCORED'):
         annotations = get_status_annotations_as_dictionary(status)
+        if statuses is not None:
+            statuses[status.id] = status
+        ids.append(status.id)
+        modified_on[status.id] = submission_mirror.to_epoch_ms(status.modifiedOn)
         for field in fields:
-            data[field].append(annotations[field])
+            scores[field].append(float(annotations[field]))
+        if 'mean_rank' in annotations and 'final_rank' in annotations:
+            rankings[status.id] = (annotations['mean_rank'], annotations['final_rank'])
+
+    return ids, modified_on, scores, rankings
+
+
+def fetch_statuses(evaluation, status_ids, status=None):
+    """
+    Return a dictionary from ID to SubmissionStatus for the given
+    submissions to an evaluation, which have the given status
+    """
+    if mirror:
+        return mirror.statuses(status_ids)
+    if len(status_ids) > RANK_FETCH_THRESHOLD:
+        status_ids = set(status_ids)
+        return {submission_status.id: submission_status
+                for submission, submission_status in fetch_submission_bundles(evaluation, status=status)
+                if submission_status.id in status_ids}
+    return {status_id: syn.getSubmissionStatus(status_id) for status_id in status_ids}
+
+
+def rank(evaluation, fields=[], dry_run=False):
+    """
+    Rank all SCORED submissions by the mean of their ranks on the given
+    fields. Only statuses whose mean_rank or final_rank change are
+    updated. Scores are read from the submission query service if it has
+    caught up with the mirror, otherwise, or without a mirror, from the
+    SCORED bundles.
+    """
+    sys.stdout.write('ranking evaluation: %s %s\n' % (evaluation.id, evaluation.name))
+    sys.stdout.flush()
+
+    ## the query service indexes changes asynchronously, so it may not yet
+    ## reflect statuses we just updated. The mirror always does, and without
+    ## one there's no telling, so the bundles are read from Synapse.
+    bundle_statuses = {}
+    if mirror:
+        ## the statuses scored in this pass were uploaded since the refresh
+        mirror.refresh_stale(evaluation)
+        ids, modified_on, scores, previous = query_ranking_inputs(evaluation, fields)
+        if mirror.modified_on(evaluation, status='SCORED') != modified_on:
+            print "the submission query service is behind, ranking from the mirror"
+            ids, modified_on, scores, previous = bundle_ranking_inputs(evaluation, fields, bundle_statuses)
+    else:
+        ids, modified_on, scores, previous = bundle_ranking_inputs(evaluation, fields, bundle_statuses)
 
-    ## return a dictionary of vectors holding statistics to be added to the submission status
-    rank_statistics = ad_challenge_scoring.mean_rank(data)
+    ranker = ranking.Ranker(fields)
+    for i, status_id in enumerate(ids):
+        ranker.add(status_id, {field: values[i] for field, values in scores.iteritems()})
 
-    if dry_run:
-        ranking = []
+    changed = ranker.changed(previous)
+    check_lock(evaluation)
 
-    ## put the ith set of stats onto the ith submission status
-    for i, status in enumerate(statuses):
+    ## put the new rankings onto the statuses whose rankings changed
+    if bundle_statuses:
+        statuses = {status_id: bundle_statuses[status_id] for status_id in changed}
+    else:
+        statuses = fetch_statuses(evaluation, list(changed), status='SCORED')
+    for status_id, (mean_rank, final_rank) in changed.iteritems():
+        status = statuses[status_id]
         annotations = get_status_annotations_as_dictionary(status)
-        annotations.update({key:values[i] for key,values in rank_statistics.iteritems()})
+        annotations['mean_rank'] = mean_rank
+        annotations['final_rank'] = final_rank
         status.annotations = synapseclient.annotations.to_submission_status_annotations(annotations, is_private=False)
-        if dry_run:
-            ranking.append((status.id, annotations['mean_rank'], annotations['final_rank']))
 
     if not dry_run:
-        update_submissions_status_batch(evaluation, statuses)
-        print "updated %d submissions" % len(statuses)
+        update_submissions_status_batch(evaluation, [statuses[status_id] for status_id in changed])
+        print "updated %d of %d submissions" % (len(changed), len(ids))
     else:
-        print "dry run: would have updated %d submissions" % len(statuses)
-        for record in sorted(ranking, key=lambda x: x[2]):
-            print "\t".join(unicode(x) for x in record).encode('utf-8')
+        print "dry run: would have updated %d of %d submissions" % (len(changed), len(ids))
+        for status_id, (mean_rank, final_rank) in sorted(ranker.rankings().iteritems(), key=lambda x: x[1][1]):
+            print "\t".join(unicode(x) for x in (status_id, mean_rank, final_rank)).encode('utf-8')
 
     sys.stdout.write('\n\n' + '-' * 60 + '\n')
 
@@ -355,7 +996,9 @@ def list_submissions(evaluation, status=None, **kwargs):
     print '\n\nSubmissions for: %s %s' % (evaluation.id, evaluation.name)
     print '-' * 60
 
-    for submission, status in syn.getSubmissionBundles(evaluation, status=status):
+    refresh_mirror(evaluation)
+
+    for submission, status in fetch_submission_bundles(evaluation, status=status):
         print submission.id, submission.createdOn, status.status, submission.name.encode('utf-8'), submission.userId
 
 
@@ -369,6 +1012,8 @@ def list_evaluations():
 
 
 def count_submissions_by_user(evaluation, status=None):
+    if mirror:
+        return mirror.count_by_user(evaluation, status=status)
     submission_counts_by_user = {}
     for submission, status in syn.getSubmissionBundles(evaluation, status=status):
         submission_counts_by_user.setdefault(submission.userId, 0)
@@ -376,6 +1021,18 @@ def count_submissions_by_user(evaluation, status=None):
     return submission_counts_by_user
 
 
+def get_quota(evaluation, submission_quota=None, statuses=('SCORED',)):
+    """
+    Return a quota.Quota holding each user's submissions to an evaluation
+    with the given statuses, by default those SCORED
+    """
+    counts = {}
+    for status in statuses:
+        for user_id, count in count_submissions_by_user(evaluation, status=status).iteritems():
+            counts[user_id] = counts.get(user_id, 0) + count
+    return quota.Quota(counts, limit=submission_quota)
+
+
 def to_ordinal(i):
     ## teens are all 1Xth
     if i % 100 >= 11 and i % 100 < 20:
@@ -402,13 +1059,16 @@ def command_validate(args):
     if int(args.evaluation) not in ad_challenge_scoring.config_evaluations_map:
         raise KeyError("Evaluation id %s isn't in the map of known evaluations." % args.evaluation)
     challenge_config = ad_challenge_scoring.config_evaluations_map[int(args.evaluation)]
-    validate(evaluation=syn.getEvaluation(args.evaluation),
+    evaluation = syn.getEvaluation(args.evaluation)
+    refresh_mirror(evaluation)
+    validate(evaluation=evaluation,
              validation_func=ad_challenge_scoring.validate_submission,
              send_messages=args.send_messages,
              notifications=args.notifications,
              dry_run=args.dry_run,
              submission_quota=challenge_config.get('submission_quota',None),
-             config=challenge_config)
+             config=challenge_config,
+             workers=args.workers)
 
 
 def command_score(args):
@@ -416,13 +1076,15 @@ def command_score(args):
         raise KeyError("Evaluation id %s isn't in the map of known evaluations." % args.evaluation)
     challenge_config = ad_challenge_scoring.config_evaluations_map[int(args.evaluation)]
     evaluation = syn.getEvaluation(args.evaluation)
+    refresh_mirror(evaluation)
     num_scored = score(evaluation=evaluation,
-                       scoring_func=ad_challenge_scoring.score_submission,
+                       batch_scoring_func=ad_challenge_scoring.score_submission_batch,
                        send_messages=args.send_messages,
                        notifications=args.notifications,
                        dry_run=args.dry_run,
                        submission_quota=challenge_config.get('submission_quota',None),
-                       config=challenge_config)
+                       config=challenge_config,
+                       workers=args.workers)
     if args.dry_run:
         print "dry run: no sense in ranking 'til we really score some submissions."
     elif num_scored > 0 and 'fields' in challenge_config:
@@ -436,6 +1098,7 @@ def command_rank(args):
         raise KeyError("Evaluation id %s isn't in the map of known evaluations." % args.evaluation)
     challenge_config = ad_challenge_scoring.config_evaluations_map[int(args.evaluation)]
     evaluation = syn.getEvaluation(args.evaluation)
+    refresh_mirror(evaluation)
     if 'fields' in challenge_config:
         rank(evaluation=evaluation,
               fields=challenge_config['fields'],
@@ -459,44 +1122,240 @@ def command_check_status(args):
 
 
 def command_reset(args):
-    for submission in args.submission:
-        status = syn.getSubmissionStatus(submission)
-        status.status = args.status
-        if not args.dry_run:
-            print unicode(syn.store(status)).encode('utf-8')
+    ## hold the locks of the submissions' evaluations, so a reset isn't
+    ## overwritten by a run scoring the same submissions
+    evaluation_ids = sorted(set(syn.restGET(Submission.getURI(submission))['evaluationId']
+                                for submission in args.submission))
+    evaluation_locks = lock.acquire_locks_or_fail(
+        [lock.evaluation_lock_name(evaluation_id) for evaluation_id in evaluation_ids],
+        lease=LOCK_LEASE)
+    try:
+        for submission in args.submission:
+            status = syn.getSubmissionStatus(submission)
+            status.status = args.status
+            if not args.dry_run:
+                stored_status = syn.store(status)
+                if mirror:
+                    mirror.put_status(stored_status)
+                print unicode(stored_status).encode('utf-8')
+    finally:
+        for evaluation_lock in evaluation_locks:
+            evaluation_lock.release()
+
+
+def process_evaluation(evaluation, challenge_config, args):
+    """
+    Validate, score and rank the submissions to an evaluation, returning
+    the number of submissions validated or scored. With a claim store,
+    submissions are claimed args.claim_batch at a time, until no more
+    can be claimed, and ranked once they're all done.
+
+    The mirror is refreshed once for the pass or, with a claim store,
+    once for each batch, to see the work of the runs sharing the evaluation.
+    """
+    processed = 0
+    scored = 0
+    while True:
+        refresh_mirror(evaluation)
+        num_validated = validate(evaluation=evaluation,
+                                 validation_func=ad_challenge_scoring.validate_submission,
+                                 send_messages=args.send_messages,
+                                 notifications=args.notifications,
+                                 dry_run=args.dry_run,
+                                 submission_quota=challenge_config.get('submission_quota',None),
+                                 config=challenge_config,
+                                 workers=args.workers,
+                                 claim_limit=args.claim_batch)
+
+        num_scored = score(evaluation=evaluation,
+                           batch_scoring_func=ad_challenge_scoring.score_submission_batch,
+                           send_messages=args.send_messages,
+                           notifications=args.notifications,
+                           dry_run=args.dry_run,
+                           submission_quota=challenge_config.get('submission_quota',None),
+                           config=challenge_config,
+                           workers=args.workers,
+                           claim_limit=args.claim_batch)
+
+        processed += num_validated + num_scored
+        scored += num_scored
+        if not claim_store or not (num_validated or num_scored) or args.dry_run or stop_requested:
+            break
+
+    if args.dry_run:
+        print "dry run: no sense in ranking 'til we really score some submissions."
+    elif scored > 0 and 'fields' in challenge_config:
+        rank(evaluation=evaluation,
+              fields=challenge_config['fields'],
+              dry_run=args.dry_run)
+    return processed
+
+
+def challenge_configs(evaluation_ids=None):
+    """
+    Return the configuration of the given evaluations or, by default, of
+    those scored as part of the challenge
+    """
+    if not evaluation_ids:
+        return [challenge_config for challenge_config in ad_challenge_scoring.config_evaluations
+                if challenge_config.get('score_as_part_of_challenge', False)]
+    for evaluation_id in evaluation_ids:
+        if int(evaluation_id) not in ad_challenge_scoring.config_evaluations_map:
+            raise KeyError("Evaluation id %s isn't in the map of known evaluations." % evaluation_id)
+    return [ad_challenge_scoring.config_evaluations_map[int(evaluation_id)] for evaluation_id in evaluation_ids]
 
 
 def command_score_challenge(args):
-    for challenge_config in ad_challenge_scoring.config_evaluations:
-        if challenge_config.get('score_as_part_of_challenge', False):
+    """
+    Validate, score and rank the evaluations in the challenge, all at
+    once, each in its own thread. Evaluations locked by another run,
+    say a score of a single evaluation, are skipped.
+    """
+    locked = []
+    for challenge_config in challenge_configs():
+        evaluation_lock = lock.Lock(lock.evaluation_lock_name(challenge_config['id']), lease=LOCK_LEASE)
+        if evaluation_lock.acquire():
+            locked.append((challenge_config, evaluation_lock))
+        else:
+            print "Skipping evaluation %s, whose lock is held by another run." % challenge_config['id']
+
+    def process_locked_evaluation((challenge_config, evaluation_lock)):
+        try:
+            if not args.dry_run:
+                open_outbox(challenge_config['id'])
             evaluation = syn.getEvaluation(challenge_config['id'])
+            return process_evaluation(evaluation, challenge_config, args)
+        except lock.LockLostException as ex1:
+            ## another run has taken over the evaluation, and will finish it
+            sys.stderr.write('Stopped scoring evaluation %s: %s\n' % (challenge_config['id'], ex1))
+        except Exception as ex1:
+            ## an error in one evaluation doesn't stop the others
+            sys.stderr.write('Error in scoring evaluation %s:\n' % challenge_config['id'])
+            report_exception(args.notifications)
+        finally:
+            close_outbox(challenge_config['id'])
+            evaluation_lock.release()
+
+    if locked:
+        pool = ThreadPool(len(locked))
+        try:
+            pool.map(process_locked_evaluation, locked)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def report_exception(notifications, subject="Exception in AD Challenge scoring harness"):
+    """
+    Write the exception being handled to stderr and, if notifications
+    are on, send it to the challenge admins
+    """
+    st = StringIO()
+    traceback.print_exc(file=st)
+    sys.stderr.write(st.getvalue())
+    sys.stderr.write('\n')
+    message = error_notification_template.format(message=st.getvalue())
+
+    if notifications:
+        response = syn.sendMessage(
+            userIds=ADMIN_USER_IDS,
+            messageSubject=subject,
+            messageBody=message)
+        print "sent notification: ", unicode(response).encode('utf-8')
+
+
+def _request_stop(signum, frame):
+    global stop_requested
+    if stop_requested:
+        ## asked twice, so stop now
+        raise SystemExit(128 + signum)
+    print "\nsignal %d: stopping once the submissions in hand are done" % signum
+    sys.stdout.flush()
+    stop_requested = True
+
+
+def command_serve(args):
+    """
+    Poll evaluations for submissions until sent SIGTERM or SIGINT,
+    keeping engines, scoring data and the Synapse login between polls.
+    Each evaluation is polled every SERVE_MIN_INTERVAL seconds while
+    submissions are arriving, backing off to SERVE_MAX_INTERVAL when idle.
+    """
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+
+    configs = challenge_configs(args.evaluation)
+    evaluations = [syn.getEvaluation(challenge_config['id']) for challenge_config in configs]
+
+    ## load everything once, before worker processes are forked
+    ad_challenge_scoring.warm_engines(configs)
+
+    intervals = [args.min_interval] * len(configs)
+    next_poll = [time.time()] * len(configs)
+
+    while not stop_requested:
+        i = min(range(len(configs)), key=lambda j: next_poll[j])
+        ## sleep in short steps, so a signal is seen promptly
+        while not stop_requested and time.time() < next_poll[i]:
+            time.sleep(min(1.0, next_poll[i] - time.time()))
+            ## waiting is progress, for a server
+            for evaluation_lock in command_locks:
+                evaluation_lock.progress()
+        if stop_requested:
+            break
+
+        try:
+            processed = process_evaluation(evaluations[i], configs[i], args)
+        except lock.LockLostException:
+            ## another run has taken over, so this server stops
+            raise
+        except Exception as ex1:
+            sys.stderr.write('Error in scoring evaluation %s:\n' % evaluations[i].id)
+            report_exception(args.notifications)
+            processed = 0
+
+        if processed:
+            intervals[i] = args.min_interval
+        else:
+            intervals[i] = min(intervals[i] * SERVE_BACKOFF, args.max_interval)
+        next_poll[i] = time.time() + intervals[i]
+        print "next poll of evaluation %s in %g seconds" % (evaluations[i].id, intervals[i])
+
+        ## keep the metrics of a long run from growing without bound
+        del batch_upload_metrics[:]
+        if args.metrics_dir:
+            metrics.write(args.metrics_dir)
+        else:
+            metrics.drain()
 
-            validate(evaluation=evaluation,
-                     validation_func=ad_challenge_scoring.validate_submission,
-                     send_messages=args.send_messages,
-                     notifications=args.notifications,
-                     dry_run=args.dry_run,
-                     submission_quota=challenge_config.get('submission_quota',None),
-                     config=challenge_config)
-
-            num_scored = score(evaluation=evaluation,
-                               scoring_func=ad_challenge_scoring.score_submission,
-                               send_messages=args.send_messages,
-                               notifications=args.notifications,
-                               dry_run=args.dry_run,
-                               submission_quota=challenge_config.get('submission_quota',None),
-                               config=challenge_config)
-            if args.dry_run:
-                print "dry run: no sense in ranking 'til we really score some submissions."
-            elif num_scored > 0 and 'fields' in challenge_config:
-                rank(evaluation=evaluation,
-                      fields=challenge_config['fields'],
-                      dry_run=args.dry_run)
+    print "serve: stopped"
+
+
+def locked_evaluation_ids(args):
+    """
+    The IDs of the evaluations whose locks are held while running a
+    command. score-challenge and reset take their locks themselves.
+    """
+    if args.func in (command_validate, command_score, command_rank):
+        return [args.evaluation]
+    if args.func == command_serve:
+        return [challenge_config['id'] for challenge_config in challenge_configs(args.evaluation)]
+    return []
+
+
+def limit_synapse_connections(syn, connections=SYNAPSE_CONNECTIONS):
+    """
+    Make requests through a Synapse client, from any number of threads,
+    wait for a free connection once connections to a host are in use
+    """
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=connections, pool_block=True)
+    syn._requests_session.mount('https://', adapter)
+    syn._requests_session.mount('http://', adapter)
 
 
 def challenge():
 
-    global syn
+    global syn, mirror, claim_store, command_locks
 
     parser = argparse.ArgumentParser()
 
@@ -506,6 +1365,11 @@ def challenge():
     parser.add_argument("--send-messages", help="Send error confirmation and validation errors to participants", action="store_true", default=False)
     parser.add_argument("--dry-run", help="Perform the requested command without updating anything in Synapse", action="store_true", default=False)
     parser.add_argument("--debug", help="Show verbose error output from Synapse API calls", action="store_true", default=False)
+    parser.add_argument("--no-mirror", help="Read submissions from Synapse rather than the local mirror", action="store_true", default=False)
+    parser.add_argument("--claims", metavar="PATH", help="Share evaluations with runs on other hosts, claiming submissions in a SQLite database at PATH on a shared filesystem, or with status annotations if PATH is 'synapse'", default=None)
+    parser.add_argument("--claim-batch", help="Number of submissions to claim at a time, with --claims", type=int, default=CLAIM_BATCH)
+    parser.add_argument("--timings", help="Report time spent starting up and running the command", action="store_true", default=False)
+    parser.add_argument("--metrics-dir", metavar="DIR", help="Write the time spent in each stage of validating and scoring to DIR, as JSON lines and a Prometheus textfile", default=None)
 
     subparsers = parser.add_subparsers(title="subcommand")
 
@@ -516,10 +1380,12 @@ def challenge():
 
     parser_validate = subparsers.add_parser('validate', help="Validate all RECEIVED submissions to an evaluation")
     parser_validate.add_argument("evaluation", metavar="EVALUATION-ID", default=None)
+    parser_validate.add_argument("--workers", help="Number of processes in which to validate and score submissions", type=int, default=1)
     parser_validate.set_defaults(func=command_validate)
 
     parser_score = subparsers.add_parser('score', help="Score all VALIDATED submissions to an evaluation")
     parser_score.add_argument("evaluation", metavar="EVALUATION-ID", default=None)
+    parser_score.add_argument("--workers", help="Number of processes in which to validate and score submissions", type=int, default=1)
     parser_score.set_defaults(func=command_score)
 
     parser_rank = subparsers.add_parser('rank', help="Rank all SCORED submissions to an evaluation")
@@ -536,48 +1402,95 @@ def challenge():
     parser_reset.set_defaults(func=command_reset)
 
     parser_score_challenge = subparsers.add_parser('score-challenge', help="Validate and score submissions to all evaluations in a challenge")
+    parser_score_challenge.add_argument("--workers", help="Number of processes in which to validate and score submissions", type=int, default=1)
     parser_score_challenge.set_defaults(func=command_score_challenge)
+
+    parser_serve = subparsers.add_parser('serve', help="Keep validating, scoring and ranking submissions as they arrive, until sent SIGTERM")
+    parser_serve.add_argument("evaluation", metavar="EVALUATION-ID", nargs='*', help="Evaluations to serve, by default those scored as part of the challenge")
+    parser_serve.add_argument("--workers", help="Number of processes in which to validate and score submissions", type=int, default=1)
+    parser_serve.add_argument("--min-interval", help="Seconds between polls while submissions are arriving", type=float, default=SERVE_MIN_INTERVAL)
+    parser_serve.add_argument("--max-interval", help="Seconds between polls of an idle evaluation", type=float, default=SERVE_MAX_INTERVAL)
+    parser_serve.set_defaults(func=command_serve)
  
     args = parser.parse_args()
 
     print "\n" * 2, "-" * 60
     print datetime.utcnow().isoformat()
 
-    ## Acquire lock, don't run two scoring scripts at once
+    timings = OrderedDict([('imports', IMPORTED - STARTED)])
+    phase_started = time.time()
+
+    ## Acquire the locks of the evaluations the command works on, so that
+    ## two runs don't work on the same evaluation at once
+    lock_ids = locked_evaluation_ids(args)
     try:
-        update_lock = lock.acquire_lock_or_fail('challenge', max_age=timedelta(hours=4))
+        args.locks = command_locks = lock.acquire_locks_or_fail(
+            [lock.evaluation_lock_name(evaluation_id) for evaluation_id in lock_ids],
+            lease=LOCK_LEASE)
     except lock.LockedException:
         print u"Is the scoring script already running? Can't acquire lock."
         # can't acquire lock, so return error code 75 which is a
         # temporary error according to /usr/include/sysexits.h
         return 75
+    timings['lock'] = time.time() - phase_started
 
     try:
+        phase_started = time.time()
         syn = synapseclient.Synapse(debug=args.debug)
         if not args.user:
             args.user = os.environ.get('SYNAPSE_USER', None)
         if not args.password:
             args.password = os.environ.get('SYNAPSE_PASSWORD', None)
         syn.login(email=args.user, password=args.password)
+        limit_synapse_connections(syn)
+        if not args.no_mirror:
+            mirror = submission_mirror.SubmissionMirror(syn)
+        if args.claims == 'synapse':
+            claim_store = claims.StatusClaimStore(syn)
+        elif args.claims:
+            claim_store = claims.SQLiteClaimStore(args.claims)
+        ## a dry run sends messages right away, since statuses aren't
+        ## updated and the same messages will be sent again by a real run
+        if not args.dry_run:
+            for evaluation_id in lock_ids:
+                open_outbox(evaluation_id)
+        timings['login'] = time.time() - phase_started
+
+        phase_started = time.time()
         args.func(args)
+        timings['command'] = time.time() - phase_started
+
+    except lock.LockLostException as ex1:
+        sys.stderr.write('Stopped: %s\n' % ex1)
+        return 75
 
     except Exception as ex1:
         sys.stderr.write('Error in scoring script:\n')
-        st = StringIO()
-        traceback.print_exc(file=st)
-        sys.stderr.write(st.getvalue())
-        sys.stderr.write('\n')
-        message = error_notification_template.format(message=st.getvalue())
-
-        if args.notifications:
-            response = syn.sendMessage(
-                userIds=ADMIN_USER_IDS,
-                messageSubject="Exception in AD Challenge scoring harness",
-                messageBody=message)
-            print "sent notification: ", unicode(response).encode('utf-8')
+        report_exception(args.notifications)
 
     finally:
-        update_lock.release()
+        ## send any messages still in the outboxes before giving up the locks
+        for evaluation_id in list(outboxes):
+            close_outbox(evaluation_id)
+        if claim_store:
+            claim_store.close()
+        if mirror:
+            mirror.close()
+        for evaluation_lock in args.locks:
+            evaluation_lock.release()
+        if args.metrics_dir:
+            metrics.write(args.metrics_dir)
+
+    if args.timings:
+        ## engines started during the command, included in its time
+        for engine, seconds in ad_challenge_scoring.engine_timings.iteritems():
+            timings['start ' + engine] = seconds
+        timings['total'] = time.time() - STARTED
+        report_timings(timings)
+        ## lookups by worker processes aren't counted
+        if result_cache.hit_rate() is not None:
+            print "    %-20s %7.1f%% of %d" % ('result cache hits', 100 * result_cache.hit_rate(),
+                                             result_cache.hits + result_cache.misses)
 
     print "\ndone: ", datetime.utcnow().isoformat()
     print "-" * 60, "\n" * 2
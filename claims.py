@@ -0,0 +1,247 @@
+##
+## Claims on submissions, so that runs of challenge.py on several hosts
+## can share the work of validating and scoring an evaluation
+##
+## Before a run validates or scores a user's submissions it claims
+## them, all of that user's at once, under a key naming the user. A
+## user whose submissions are claimed by another worker is skipped.
+## So the worker holding a claim is the only one counting the user's
+## submissions against the quota and numbering them, and can do that
+## from the statuses it reads once the claim is taken. Claims expire,
+## so the submissions claimed by a worker that dies are taken up by the
+## others. Each host runs challenge.py in its own working directory,
+## with its own locks, outboxes and mirror; only the claims are shared.
+##
+## SQLiteClaimStore keeps claims in a SQLite database on a filesystem
+## shared by the hosts, renewing them from a heartbeat thread while
+## they're held. StatusClaimStore keeps them in private annotations on
+## the submissions' statuses, claiming a submission by storing its
+## status with the etag it was read with, so only one of several
+## workers racing to claim it succeeds.
+############################################################
+
+import abc
+import copy
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from synapseclient import SubmissionStatus
+from synapseclient.exceptions import SynapseHTTPError
+
+
+## seconds a claim in a SQLiteClaimStore lasts without being renewed
+CLAIM_TTL = 2 * 60
+
+## seconds a claim in a StatusClaimStore lasts, which isn't renewed, so
+## must outlast the validation or scoring of a batch of submissions
+STATUS_CLAIM_TTL = 30 * 60
+
+## seconds to wait for another worker's claim transaction to finish
+BUSY_TIMEOUT = 60
+
+## annotations holding a claim on a submission status
+CLAIM_OWNER = "claim_owner"
+CLAIM_EXPIRES = "claim_expires"
+CLAIM_ANNOTATIONS = (CLAIM_OWNER, CLAIM_EXPIRES)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS claims (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+
+def worker_name():
+    """A name for this process that's unique across hosts and runs"""
+    return "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def remove_claim(status):
+    """
+    Remove the annotations holding a StatusClaimStore's claim from a
+    status, so that storing it releases the claim
+    """
+    annotations = status.get('annotations') or {}
+    if 'stringAnnos' in annotations:
+        annotations['stringAnnos'] = [annotation for annotation in annotations['stringAnnos']
+                                      if annotation['key'] not in CLAIM_ANNOTATIONS]
+    return status
+
+
+class ClaimStore(object):
+    """
+    Claims on groups of submissions, held by this worker until released
+    or expired
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, ttl):
+        self.owner = worker_name()
+        self.ttl = ttl
+
+    @abc.abstractmethod
+    def claim_statuses(self, key, statuses):
+        """
+        Claim the submissions with the given statuses together, under key.
+        Returns the statuses to work on, which may have been updated by
+        the claim, or None if another worker holds the key or any of the
+        submissions.
+        """
+
+    @abc.abstractmethod
+    def release(self, key):
+        """
+        Give up the claim on key, once the new statuses of its submissions
+        are stored
+        """
+
+    def close(self):
+        """
+        Release all claims
+        """
+        pass
+
+
+class SQLiteClaimStore(ClaimStore):
+    """
+    Claims kept in a SQLite database at path, renewed while held
+    """
+
+    def __init__(self, path, ttl=CLAIM_TTL):
+        super(SQLiteClaimStore, self).__init__(ttl)
+        ## transactions are begun explicitly, so a claim is checked and taken at once
+        self.db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.db_lock = threading.Lock()
+        self.db.executescript(SCHEMA)
+        self.held = set()
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat = threading.Thread(target=self._renew_until_closed, name="claims-heartbeat")
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+
+    def claim(self, key):
+        """
+        Claim key, returning False if another worker's claim on it hasn't expired
+        """
+        now = time.time()
+        with self.db_lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT owner, expires FROM claims WHERE key=?", (key,)).fetchone()
+                claimed = row is None or row[0] == self.owner or row[1] <= now
+                if claimed:
+                    self.db.execute("INSERT OR REPLACE INTO claims VALUES (?, ?, ?)", (key, self.owner, now + self.ttl))
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            if claimed:
+                self.held.add(key)
+        return claimed
+
+    def claim_statuses(self, key, statuses):
+        return statuses if self.claim(key) else None
+
+    def release(self, key):
+        with self.db_lock:
+            self.db.execute("DELETE FROM claims WHERE key=? AND owner=?", (key, self.owner))
+            self.held.discard(key)
+
+    def renew(self):
+        """
+        Extend this worker's claims
+        """
+        with self.db_lock:
+            if self.held:
+                self.db.execute("UPDATE claims SET expires=? WHERE owner=?", (time.time() + self.ttl, self.owner))
+
+    def _renew_until_closed(self):
+        while not self.stop_heartbeat.wait(self.ttl / 4.0):
+            try:
+                self.renew()
+            except sqlite3.Error as err:
+                ## tried again at the next beat, before the claims expire
+                sys.stderr.write("Can't renew claims: %s\n" % err)
+
+    def close(self):
+        self.stop_heartbeat.set()
+        self.heartbeat.join()
+        with self.db_lock:
+            self.db.execute("DELETE FROM claims WHERE owner=?", (self.owner,))
+            self.held.clear()
+        self.db.close()
+
+
+class StatusClaimStore(ClaimStore):
+    """
+    Claims kept in private annotations on submission statuses, through
+    a Synapse client. Claims aren't renewed, and keys aren't stored; a
+    key is held through the claims on its submissions. The status that a
+    run stores for a submission it has validated keeps the claim, so the
+    same run gets to score it. A status stored as INVALID or SCORED
+    drops it, see remove_claim.
+    """
+
+    def __init__(self, syn, ttl=STATUS_CLAIM_TTL):
+        super(StatusClaimStore, self).__init__(ttl)
+        self.syn = syn
+
+    def claim_statuses(self, key, statuses):
+        claimed = []
+        for status in statuses:
+            claimed_status = self.claim_status(status)
+            if claimed_status is None:
+                ## give up the others, so the user's submissions are left together
+                for held in claimed:
+                    self.unclaim_status(held)
+                return None
+            claimed.append(claimed_status)
+        return claimed
+
+    def claim_status(self, status):
+        """
+        Claim a submission, given its status, returning the stored status
+        or None if another worker holds the claim
+        """
+        annotations = {annotation['key']: annotation['value']
+                       for annotation in (status.get('annotations') or {}).get('stringAnnos', [])}
+        if (annotations.get(CLAIM_OWNER, self.owner) != self.owner
+                and float(annotations.get(CLAIM_EXPIRES, 0)) > time.time()):
+            return None
+
+        claimed = SubmissionStatus(**copy.deepcopy(dict(status)))
+        claimed.annotations = claimed.get('annotations') or {}
+        string_annos = [annotation for annotation in claimed.annotations.get('stringAnnos', [])
+                        if annotation['key'] not in CLAIM_ANNOTATIONS]
+        string_annos.append({'key': CLAIM_OWNER, 'value': self.owner, 'isPrivate': True})
+        string_annos.append({'key': CLAIM_EXPIRES, 'value': repr(time.time() + self.ttl), 'isPrivate': True})
+        claimed.annotations['stringAnnos'] = string_annos
+        try:
+            return self.syn.store(claimed)
+        except SynapseHTTPError as err:
+            ## another worker stored the status first
+            if err.response.status_code == 412:
+                return None
+            raise
+
+    def unclaim_status(self, status):
+        """
+        Give up the claim on a submission that won't be worked on
+        """
+        try:
+            self.syn.store(remove_claim(SubmissionStatus(**copy.deepcopy(dict(status)))))
+        except SynapseHTTPError as err:
+            ## the status has moved on, and the claim expires anyway
+            if err.response.status_code != 412:
+                raise
+
+    def release(self, key):
+        ## the claims were removed, or kept for scoring, in the stored statuses
+        pass
@@ -1,72 +1,290 @@
+##
+## Named locks held as leases
+##
+## A lock is a file, [lockname].lease, holding the lease of its owner:
+## process ID, hostname and the time the lease expires. The file is
+## only read and written holding an fcntl lock on it, so checking a
+## lease and taking it over is atomic. fcntl locks, unlike flock, aren't
+## inherited by forked worker processes, but nor do they exclude other
+## threads, so threads take turns with _lease_files_lock.
+##
+## While a lock is held, a heartbeat thread renews its lease, so leases
+## can be short, but only as long as its holder reports progress, so a
+## hung process loses its locks. A holder that finds, on reporting
+## progress, that its lease was lost gets a LockLostException and must
+## stop work. A lease that has expired, or whose owner is a process on
+## this host that has died, is taken over at once. Hosts sharing locks,
+## over NFS say, need their clocks set by NTP.
+############################################################
+
 import argparse
 import errno
+import fcntl
 import inspect
+import json
 import os
-import shutil
+import socket
 import sys
+import threading
 import time
+import uuid
+from contextlib import contextmanager
 from datetime import timedelta
 
-LOCK_DEFAULT_MAX_AGE = timedelta(hours=2)
+LOCK_DEFAULT_LEASE = timedelta(minutes=1)
+
+## how long a lease is renewed after its holder last reported progress
+LOCK_DEFAULT_STALL = timedelta(minutes=10)
+
+## seconds between attempts to acquire a lock with a timeout
+LOCK_POLL_INTERVAL = 1.0
+
+## a dictionary for each attempt to acquire a lock, recording whether it
+## was acquired, whether another owner held it, the seconds spent waiting
+## for it, why a previous owner's lease was taken over, how often it was
+## renewed, whether it was lost and, once released, the seconds it was held
+metrics = []
+
+## held by the thread reading or writing a lease file
+_lease_files_lock = threading.Lock()
+
+## the locks held by this process, by name
+held_locks = {}
 
 
 class LockedException(Exception):
     pass
 
-def acquire_lock_or_fail(name, max_age=LOCK_DEFAULT_MAX_AGE):
-    lock = Lock(name, max_age=max_age)
-    if lock.acquire():
+class LockLostException(Exception):
+    pass
+
+def acquire_lock_or_fail(name, lease=LOCK_DEFAULT_LEASE, timeout=0, stall=LOCK_DEFAULT_STALL):
+    lock = Lock(name, lease=lease, stall=stall)
+    if lock.acquire(timeout=timeout):
         return lock
-    raise LockedException("A lock exists named %s who's age is: %s" % (name, unicode(lock.get_age())))
+    raise LockedException("A lock named %s is held by %s" % (name, describe_lease(lock.owner())))
+
+
+def evaluation_lock_name(evaluation_id):
+    """The name of the lock held while working on an evaluation queue"""
+    return "evaluation-%s" % evaluation_id
+
+
+def acquire_locks_or_fail(names, lease=LOCK_DEFAULT_LEASE, timeout=0, stall=LOCK_DEFAULT_STALL):
+    """Acquire all the named locks, or none of them"""
+    locks = []
+    try:
+        for name in names:
+            locks.append(acquire_lock_or_fail(name, lease=lease, timeout=timeout, stall=stall))
+    except LockedException:
+        for held in locks:
+            held.release()
+        raise
+    return locks
+
+
+def progress(name):
+    """
+    Report progress on the work guarded by the named lock, if this
+    process holds it, see Lock.progress
+    """
+    lock = held_locks.get(name)
+    if lock:
+        lock.progress()
+
+
+def describe_lease(lease):
+    if lease is None:
+        return "nobody"
+    return "process %s on %s until %s" % (
+        lease['pid'], lease['hostname'], time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(lease['expires'])))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
 
 
 class Lock(object):
     """
-    Implements a lock by making a directory named [lockname].lock
+    Implements a lock as a lease, renewed by a heartbeat thread while
+    its holder reports progress, held in a file named [lockname].lease
     """
-    SUFFIX = 'lock'
+    SUFFIX = 'lease'
 
-    def __init__(self, name, dir=None, max_age=LOCK_DEFAULT_MAX_AGE):
+    def __init__(self, name, dir=None, lease=LOCK_DEFAULT_LEASE, stall=LOCK_DEFAULT_STALL):
         self.name = name
         self.held = False
+        self.lost = False
+        self.stall = stall.total_seconds()
+        self.progressed = None
         self.dir = dir if dir else os.getcwd()
-        self.lock_dir_path = os.path.join(self.dir, ".".join([name, Lock.SUFFIX]))
-        self.max_age = max_age
+        self.path = os.path.join(self.dir, ".".join([name, Lock.SUFFIX]))
+        self.lease = lease.total_seconds()
+        self.token = None
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat = None
+        self.metrics = None
 
-    def get_age(self):
-        return timedelta(seconds=time.time() - os.path.getmtime(self.lock_dir_path))
+    @contextmanager
+    def _lease_file(self):
+        """Open the lease file, holding a lock on it until closed"""
+        with _lease_files_lock:
+            with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0644), 'r+') as f:
+                fcntl.lockf(f.fileno(), fcntl.LOCK_EX)
+                yield f
 
-    def acquire(self, break_old_locks=True):
-        """Try to acquire lock. Return True on success or False otherwise"""
+    def _read(self, f):
+        f.seek(0)
+        text = f.read()
         try:
-            os.makedirs(self.lock_dir_path)
+            return json.loads(text) if text else None
+        except ValueError:
+            ## left by an owner that died while writing it
+            return None
+
+    def _write(self, f, lease):
+        f.seek(0)
+        f.truncate()
+        if lease:
+            f.write(json.dumps(lease))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _new_lease(self, acquired):
+        now = time.time()
+        return {'pid': os.getpid(), 'hostname': socket.gethostname(), 'token': self.token,
+                'acquired': acquired, 'expires': now + self.lease}
+
+    def owner(self):
+        """Return the lease of the lock's owner, or None if it's free"""
+        with self._lease_file() as f:
+            lease = self._read(f)
+        if lease is None or self._takeover_reason(lease):
+            return None
+        return lease
+
+    def _takeover_reason(self, lease):
+        """Return why a lease can be taken over, or None if it can't"""
+        if lease['expires'] <= time.time():
+            return "lease expired"
+        if lease['hostname'] == socket.gethostname() and not _pid_alive(lease['pid']):
+            return "owner is dead"
+        return None
+
+    def _try_acquire(self):
+        """Take the lease if it's free, returning (acquired, previous owner's lease, reason)"""
+        with self._lease_file() as f:
+            lease = self._read(f)
+            reason = self._takeover_reason(lease) if lease else None
+            if lease is None or reason:
+                self.token = uuid.uuid4().hex
+                self._write(f, self._new_lease(time.time()))
+                return True, lease, reason
+        return False, lease, None
+
+    def acquire(self, timeout=0):
+        """
+        Try to acquire lock, waiting up to timeout seconds for it to be
+        free. Return True on success or False otherwise
+        """
+        if self.held:
+            return True
+        started = time.time()
+        contended = False
+        while True:
+            acquired, previous, reason = self._try_acquire()
+            if acquired or time.time() - started >= timeout:
+                break
+            contended = True
+            time.sleep(min(LOCK_POLL_INTERVAL, max(0, timeout - (time.time() - started))))
+        contended = contended or not acquired
+
+        self.metrics = {'name': self.name, 'acquired': acquired, 'contended': contended,
+                        'wait': time.time() - started, 'taken_over': reason, 'renewals': 0, 'lost': False}
+        metrics.append(self.metrics)
+
+        if acquired:
+            if reason:
+                sys.stderr.write("Taking over lock %s from %s: %s\n" % (self.name, describe_lease(previous), reason))
             self.held = True
-            # Make sure the modification times are correct
-            # On some machines, the modification time could be seconds off
-            os.utime(self.lock_dir_path, (0, time.time()))
-        except OSError as err:
-            if err.errno != errno.EEXIST and err.errno != errno.EACCES:
-                raise
-            # already locked...
-            if break_old_locks and self.get_age() > self.max_age:
-                sys.stderr.write("Breaking lock who's age is: %s\n" % self.get_age())
-                self.held = True
-                # Make sure the modification times are correct
-                # On some machines, the modification time could be seconds off
-                os.utime(self.lock_dir_path, (0, time.time()))
-            else:
-                self.held = False
+            self.lost = False
+            self.acquired_time = self.progressed = time.time()
+            held_locks[self.name] = self
+            self._start_heartbeat()
         return self.held
 
+    def _start_heartbeat(self):
+        self.stop_heartbeat.clear()
+        self.heartbeat = threading.Thread(target=self._renew_until_released, name="lock-%s" % self.name)
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+
+    def renew(self):
+        """
+        Extend the lease of a held lock. Return False if the lease was
+        lost, having expired and been taken over
+        """
+        with self._lease_file() as f:
+            lease = self._read(f)
+            if not lease or lease['token'] != self.token:
+                self.held = False
+                self.lost = True
+                self.metrics['lost'] = True
+                return False
+            self._write(f, self._new_lease(lease['acquired']))
+        self.metrics['renewals'] += 1
+        return True
+
+    def progress(self):
+        """
+        Report that the work guarded by the lock is progressing, so its
+        lease is renewed for another stall period. Raises LockLostException
+        if the lease was lost, after which the holder mustn't carry on.
+        """
+        if self.held and not self.heartbeat.is_alive():
+            ## the heartbeat stopped for want of progress, so the lease may
+            ## have run out and been taken over
+            if self.renew():
+                self.progressed = time.time()
+                self._start_heartbeat()
+        if self.lost:
+            raise LockLostException("Lost lock %s, now held by %s" % (self.name, describe_lease(self.owner())))
+        self.progressed = time.time()
+
+    def _renew_until_released(self):
+        while not self.stop_heartbeat.wait(self.lease / 4.0):
+            if time.time() - self.progressed > self.stall:
+                ## let the lease run out, so another run can take over from a hung one
+                sys.stderr.write("No progress under lock %s for %d seconds, no longer renewing it\n" % (
+                    self.name, time.time() - self.progressed))
+                return
+            try:
+                if not self.renew():
+                    sys.stderr.write("Lost lock %s, now held by %s\n" % (self.name, describe_lease(self.owner())))
+                    return
+            except (IOError, OSError) as err:
+                ## tried again at the next beat, before the lease runs out
+                sys.stderr.write("Can't renew lock %s: %s\n" % (self.name, err))
+
     def release(self):
         """Release lock or do nothing if lock is not held"""
+        if self.heartbeat:
+            self.stop_heartbeat.set()
+            self.heartbeat.join()
+            self.heartbeat = None
+        if held_locks.get(self.name) is self:
+            del held_locks[self.name]
         if self.held:
-            try:
-                shutil.rmtree(self.lock_dir_path)
-                self.held = False
-            except OSError as err:
-                if err.errno != errno.ENOENT:
-                    raise
+            with self._lease_file() as f:
+                lease = self._read(f)
+                if lease and lease['token'] == self.token:
+                    self._write(f, None)
+            self.held = False
+            self.metrics['held'] = time.time() - self.acquired_time
 
 
 
@@ -80,7 +298,7 @@ def _sleep(seconds=0):
 
 
 if __name__ == "__main__":
-    lock = acquire_lock_or_fail('foo', max_age=timedelta(seconds=10))
+    lock = acquire_lock_or_fail('foo', lease=timedelta(seconds=10))
     try:
         parser = argparse.ArgumentParser()
 
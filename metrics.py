@@ -0,0 +1,206 @@
+##
+## Timing of the stages of validating and scoring submissions
+##
+## Code on the hot path wraps each stage in timed(stage), naming the
+## submission it's working on, if any. Stages timed within a stage
+## that names a submission are counted against that submission too.
+## Worker processes hand their timings back with their results, see
+## challenge.py:_map.
+##
+## At the end of a run, write() appends a line of JSON for each
+## submission, with the seconds it spent in each stage, and a line
+## with a histogram of each stage's timings, to metrics.jsonl. It also
+## adds the histograms to those in challenge.prom, for the Prometheus
+## node exporter's textfile collector, which are cumulative across runs
+## as Prometheus expects of a histogram.
+############################################################
+
+import errno
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+JSON_LINES_FILENAME = "metrics.jsonl"
+
+PROMETHEUS_FILENAME = "challenge.prom"
+
+## a line of a histogram in challenge.prom: its kind, stage, bucket bound and value
+PROMETHEUS_LINE = re.compile(r'^challenge_stage_seconds_(bucket|sum|count)\{stage="([^"]*)"(?:,le="([^"]*)")?\} (\S+)$')
+
+## upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, float('inf'))
+
+## (stage, submission ID or None, seconds) for each stage timed since the last write
+timings = []
+
+## held while updating timings, which threads share
+timings_lock = threading.Lock()
+
+## the submission being worked on by each thread
+current = threading.local()
+
+
+def record(stage, seconds, submission_id=None):
+    with timings_lock:
+        timings.append((stage, submission_id, seconds))
+
+
+@contextmanager
+def timed(stage, submission_id=None):
+    """
+    Time the stage run in a with block, for the given submission or,
+    by default, the submission of the enclosing stage
+    """
+    outer = getattr(current, 'submission_id', None)
+    if submission_id is None:
+        submission_id = outer
+    current.submission_id = submission_id
+    started = time.time()
+    try:
+        yield
+    finally:
+        record(stage, time.time() - started, submission_id)
+        current.submission_id = outer
+
+
+def drain():
+    """
+    Return the timings recorded since the last drain or write, and forget them
+    """
+    with timings_lock:
+        drained = list(timings)
+        del timings[:]
+    return drained
+
+
+def merge(drained):
+    """
+    Add timings drained in another process
+    """
+    with timings_lock:
+        timings.extend(drained)
+
+
+def histograms(drained):
+    """
+    Return an OrderedDict from stage to a histogram of its timings, a
+    dictionary holding the count, sum and cumulative bucket counts
+    """
+    result = OrderedDict()
+    for stage, submission_id, seconds in drained:
+        histogram = result.setdefault(stage, {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)})
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+    return result
+
+
+def _bound(bound):
+    return "+Inf" if bound == float('inf') else repr(bound)
+
+
+def read_prometheus(path):
+    """
+    Return the histograms written to a Prometheus textfile by write, by
+    stage, or an empty OrderedDict if there's no such file
+    """
+    result = OrderedDict()
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except IOError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        return result
+    bounds = [_bound(bound) for bound in BUCKETS]
+    for line in lines:
+        match = PROMETHEUS_LINE.match(line)
+        if not match:
+            continue
+        kind, stage, bound, value = match.groups()
+        histogram = result.setdefault(stage, {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)})
+        if kind == 'bucket':
+            if bound in bounds:
+                histogram['buckets'][bounds.index(bound)] = int(value)
+        elif kind == 'sum':
+            histogram['sum'] = float(value)
+        else:
+            histogram['count'] = int(value)
+    return result
+
+
+def add_histograms(totals, histograms):
+    """
+    Add histograms, by stage, into totals
+    """
+    for stage, histogram in histograms.iteritems():
+        total = totals.setdefault(stage, {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)})
+        total['count'] += histogram['count']
+        total['sum'] += histogram['sum']
+        total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+    return totals
+
+
+def write(dir, run_id=None):
+    """
+    Write the timings recorded since the last write to dir, as JSON lines
+    and added to the histograms of a Prometheus textfile, and forget them
+    """
+    drained = drain()
+    run_id = run_id or uuid.uuid4().hex
+    now = time.time()
+
+    try:
+        os.makedirs(dir)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+    by_submission = OrderedDict()
+    for stage, submission_id, seconds in drained:
+        if submission_id is not None:
+            stages = by_submission.setdefault(submission_id, OrderedDict())
+            stages[stage] = stages.get(stage, 0.0) + seconds
+    stage_histograms = histograms(drained)
+
+    with open(os.path.join(dir, JSON_LINES_FILENAME), 'a') as f:
+        for submission_id, stages in by_submission.iteritems():
+            f.write(json.dumps({'type': 'submission', 'run': run_id, 'time': now,
+                                'submission': submission_id, 'stages': stages}) + '\n')
+        f.write(json.dumps({'type': 'run', 'run': run_id, 'time': now,
+                            'buckets': [_bound(bound) for bound in BUCKETS],
+                            'stages': stage_histograms}) + '\n')
+
+    prometheus_path = os.path.join(dir, PROMETHEUS_FILENAME)
+    totals = add_histograms(read_prometheus(prometheus_path), stage_histograms)
+
+    lines = ["# HELP challenge_stage_seconds Seconds spent in each stage of validating and scoring submissions",
+             "# TYPE challenge_stage_seconds histogram"]
+    for stage, histogram in totals.iteritems():
+        for bound, count in zip(BUCKETS, histogram['buckets']):
+            lines.append('challenge_stage_seconds_bucket{stage="%s",le="%s"} %d' % (stage, _bound(bound), count))
+        lines.append('challenge_stage_seconds_sum{stage="%s"} %r' % (stage, histogram['sum']))
+        lines.append('challenge_stage_seconds_count{stage="%s"} %d' % (stage, histogram['count']))
+    lines.append("# HELP challenge_last_run_timestamp_seconds When the last run's timings were written")
+    lines.append("# TYPE challenge_last_run_timestamp_seconds gauge")
+    lines.append("challenge_last_run_timestamp_seconds %r" % now)
+
+    ## write to a temporary file and rename, so the collector never reads a partial file
+    fd, temp_path = tempfile.mkstemp(dir=dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, prometheus_path)
+    except:
+        os.remove(temp_path)
+        raise
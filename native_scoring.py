@@ -0,0 +1,780 @@
+##
+## Native implementations of the scoring functions in
+## validate_and_score.R, written against NumPy so that
+## submissions can be scored without a round trip through
+## the embedded R interpreter.
+##
+## The functions named score_q[n] have the same signature
+## as their R counterparts: function(submission_path, observed_path)
+## and return a dict with the same keys. An evaluation is
+## scored by these functions when its entry in
+## ad_challenge_scoring.config_evaluations has
+## 'scoring_engine': 'native'.
+############################################################
+
+import csv
+import math
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from itertools import count, izip
+
+import numpy as np
+
+import metrics
+
+
+## same default as in validate_and_score.R, test.py points both at test_data
+DATA_DIR = "data/scoring"
+
+## cache the scoring data so we don't keep re-reading it, see read_scoring_data
+SCORING_DATA_CACHE = {}
+
+## submissions parsed by native_validation, waiting to be scored, see read_submission
+PARSED_SUBMISSIONS = OrderedDict()
+PARSED_SUBMISSIONS_MAX = 1000
+
+## held while updating SCORING_DATA_CACHE or PARSED_SUBMISSIONS, which
+## pipelines share, and by challenge.py while forking worker processes
+cache_lock = threading.RLock()
+
+## columns that identify subjects or samples in scoring data files
+ID_COLUMNS = ('projid', 'Sample.ID', 'ID')
+
+NA_STRINGS = ('NA', '')
+
+## the largest value R's read.table reads into an integer column
+R_INT_MAX = 2**31 - 1
+
+
+def make_name(name):
+    """
+    Mimic R's make.names, which read.table applies to column headers
+    """
+    name = re.sub(r'[^A-Za-z0-9._]', '.', name)
+    if not name or re.match(r'^([0-9_]|\.[0-9])', name):
+        name = 'X' + name
+    return name
+
+
+def tokenize_whitespace(line):
+    """
+    Split a line on whitespace as read.table does, respecting
+    double quoted fields and dropping comments
+    """
+    if '"' not in line:
+        return line.split('#', 1)[0].split()
+    tokens = []
+    for i, chunk in enumerate(line.split('"')):
+        if i % 2 == 1:
+            tokens.append(chunk)
+        else:
+            if '#' in chunk:
+                tokens.extend(chunk.split('#', 1)[0].split())
+                break
+            tokens.extend(chunk.split())
+    return tokens
+
+
+def iter_rows(path):
+    """
+    Generate the rows of a file one line at a time, like _read_rows,
+    so that a reader can stop early without reading the whole file
+    """
+    with open(path, 'rU') as f:
+        if path.endswith('.csv'):
+            for row in csv.reader(f):
+                if row:
+                    yield [value.decode('utf-8').strip() for value in row]
+        else:
+            for line in f:
+                row = tokenize_whitespace(line.decode('utf-8'))
+                if row:
+                    yield row
+
+
+def _read_rows(path):
+    """
+    Read the rows of a submission or scoring data file as lists of
+    strings, csv if the path ends in .csv otherwise whitespace delimited
+    """
+    with open(path, 'rU') as f:
+        text = f.read()
+    if path.endswith('.csv'):
+        return [[value.decode('utf-8').strip() for value in row]
+                for row in csv.reader(text.splitlines()) if row]
+    text = text.decode('utf-8')
+    if '"' in text or '#' in text:
+        rows = (tokenize_whitespace(line) for line in text.splitlines())
+    else:
+        rows = (line.split() for line in text.splitlines())
+    return [row for row in rows if row]
+
+
+def read_delim_or_csv(path):
+    """
+    Read either a csv or tab delimited file into an OrderedDict
+    mapping column names to lists of strings. Short rows are
+    filled with NA, as with read.table(fill=TRUE).
+    """
+    rows = _read_rows(path)
+    if not rows:
+        raise ValueError("no lines available in input")
+    header = [make_name(name) for name in rows[0]]
+    n = len(header)
+    if any(len(row) > n for row in rows):
+        raise ValueError("more columns than column names")
+    body = [row if len(row) == n else row + ['NA'] * (n - len(row)) for row in rows[1:]]
+    columns = [list(column) for column in zip(*body)] if body else [[] for name in header]
+    return OrderedDict(zip(header, columns))
+
+
+def r_double_string(x):
+    """
+    Mimic R's as.character on a double: 15 significant digits, in fixed
+    or scientific notation, whichever is shorter
+    """
+    if math.isnan(x):
+        return 'NaN'
+    if math.isinf(x):
+        return 'Inf' if x > 0 else '-Inf'
+    if x == 0:
+        return '0'
+    mantissa, exponent = ('%.14e' % x).split('e')
+    mantissa = mantissa.rstrip('0').rstrip('.')
+    exponent = int(exponent)
+    scientific = '%se%s%02d' % (mantissa, '-' if exponent < 0 else '+', abs(exponent))
+    digits = len(mantissa.lstrip('-').replace('.', ''))
+    fixed = '%.*f' % (max(0, digits - 1 - exponent), x)
+    return fixed if len(fixed) <= len(scientific) else scientific
+
+
+def _convert_column(values, convert):
+    return [None if value in NA_STRINGS else convert(value) for value in values]
+
+
+def id_keys(values):
+    """
+    The IDs in a column of strings as R matches them. read.table reads a
+    column that's all numbers as integers or doubles, and the scoring
+    code matches IDs through as.character, so "0123", "123" and "123.0"
+    are all the ID "123". Other columns are matched as they are. Missing
+    values become None.
+    """
+    try:
+        integers = _convert_column(values, int)
+        if all(i is None or abs(i) <= R_INT_MAX for i in integers):
+            return [None if i is None else str(i) for i in integers]
+    except ValueError:
+        pass
+    try:
+        doubles = _convert_column(values, float)
+    except ValueError:
+        return list(values)
+    return [None if x is None else r_double_string(x) for x in doubles]
+
+
+class ScoringData(OrderedDict):
+    """
+    The columns of a scoring data file along with its version, the
+    column holding IDs and an index mapping each ID, as given by
+    id_keys, to its row
+    """
+    def __init__(self, columns, version):
+        super(ScoringData, self).__init__(columns)
+        self.version = version
+        self.id_column = next((name for name in ID_COLUMNS if name in self), None)
+        self.ids = id_keys(self.get(self.id_column, []))
+        self.index = dict((id, i) for id, i in izip(self.ids, count()) if id)
+
+
+def read_scoring_data(filename):
+    """
+    Get the scoring data from cache or read from disk. Cache entries
+    are keyed by path and hold the file's modification time and size,
+    so an updated file is re-read.
+    """
+    path = os.path.join(DATA_DIR, filename)
+    info = os.stat(path)
+    version = (info.st_mtime, info.st_size)
+    with cache_lock:
+        scoring_data = SCORING_DATA_CACHE.get(path)
+    if scoring_data is None or scoring_data.version != version:
+        ## read without the lock, so other pipelines aren't held up
+        scoring_data = ScoringData(read_delim_or_csv(path), version)
+        with cache_lock:
+            SCORING_DATA_CACHE[path] = scoring_data
+    return scoring_data
+
+
+def invalidate_scoring_data(filename=None):
+    """
+    Drop cached scoring data for one file or, by default, all files
+    """
+    with cache_lock:
+        if filename is None:
+            SCORING_DATA_CACHE.clear()
+        else:
+            SCORING_DATA_CACHE.pop(os.path.join(DATA_DIR, filename), None)
+
+
+def _file_version(path):
+    info = os.stat(path)
+    return (path, info.st_mtime, info.st_size)
+
+
+def store_parsed_submission(path, columns):
+    """
+    Hold on to the columns of a submission file parsed during validation,
+    so that scoring doesn't have to read the file again
+    """
+    version = _file_version(path)
+    with cache_lock:
+        PARSED_SUBMISSIONS[version] = columns
+        while len(PARSED_SUBMISSIONS) > PARSED_SUBMISSIONS_MAX:
+            PARSED_SUBMISSIONS.popitem(last=False)
+
+
+def parsed_submission(path):
+    """
+    Get the columns stored by store_parsed_submission without
+    removing them, or None
+    """
+    version = _file_version(path)
+    with cache_lock:
+        return PARSED_SUBMISSIONS.get(version)
+
+
+def read_submission(path):
+    """
+    Get the columns of a submission stored by store_parsed_submission,
+    or read it from disk
+    """
+    version = _file_version(path)
+    with cache_lock:
+        columns = PARSED_SUBMISSIONS.pop(version, None)
+    if columns is None:
+        with metrics.timed('parsing'):
+            columns = read_delim_or_csv(path)
+    return columns
+
+
+def as_numeric(values):
+    """
+    Convert a column of strings to a float array, NA and blank become NaN
+    """
+    try:
+        return np.array(values, dtype=np.float64)
+    except ValueError:
+        return np.array([np.nan if value in NA_STRINGS else float(value) for value in values],
+                        dtype=np.float64)
+
+
+def align(predicted_ids, observed_index):
+    """
+    Inner join predicted IDs to observed data through its index of
+    IDs to rows, equivalent to R's merge() on a key that is unique in
+    the observed data. IDs are matched as R matches them, see id_keys.
+    Returns a pair of index arrays into the predicted and observed rows.
+    """
+    predicted_rows = []
+    observed_rows = []
+    for i, id in enumerate(id_keys(predicted_ids)):
+        j = observed_index.get(id)
+        if j is not None:
+            predicted_rows.append(i)
+            observed_rows.append(j)
+    return np.array(predicted_rows, dtype=np.intp), np.array(observed_rows, dtype=np.intp)
+
+
+def permutation(predicted_ids, observed_index):
+    """
+    If the predicted IDs are a rearrangement of the observed IDs,
+    return the index array that puts the predicted rows in observed
+    order, otherwise None.
+    """
+    if len(predicted_ids) != len(observed_index):
+        return None
+    pi, oi = align(predicted_ids, observed_index)
+    if len(oi) != len(observed_index) or len(set(oi)) != len(observed_index):
+        return None
+    order = np.empty(len(oi), dtype=np.intp)
+    order[oi] = pi
+    return order
+
+
+## Kernels
+##
+## The kernels work on the rows of a matrix of predictions, one row
+## per submission, against a single vector of observed values, so
+## that a whole queue can be scored in a few matrix operations.
+############################################################
+
+def rank_average_rows(X):
+    """
+    Ranks of each row of X with ties given their average rank, like R's rank()
+    """
+    X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+    n_rows, n = X.shape
+    rows = np.arange(n_rows)[:, np.newaxis]
+    index = np.arange(n)
+
+    order = np.argsort(X, axis=1, kind='mergesort')
+    sorted_X = X[rows, order]
+
+    ## mark the first and last position of each run of tied values
+    is_first = np.ones(X.shape, dtype=bool)
+    is_first[:, 1:] = sorted_X[:, 1:] != sorted_X[:, :-1]
+    is_last = np.ones(X.shape, dtype=bool)
+    is_last[:, :-1] = is_first[:, 1:]
+    first = np.maximum.accumulate(np.where(is_first, index, 0), axis=1)
+    last = np.minimum.accumulate(np.where(is_last, index, n)[:, ::-1], axis=1)[:, ::-1]
+
+    ranks = np.empty(X.shape, dtype=np.float64)
+    ranks[rows, order] = (first + last) / 2.0 + 1
+    return ranks
+
+
+def rank_average(x):
+    """
+    Ranks of x with ties given their average rank, like R's rank()
+    """
+    return rank_average_rows(x)[0]
+
+
+def pearson_rows(X, y):
+    """
+    Pearson correlation of each row of X with y, NaN when either has
+    zero variance or there are fewer than two observations
+    """
+    X = np.atleast_2d(X)
+    if len(y) < 2:
+        return np.repeat(np.nan, X.shape[0])
+    Xc = X - X.mean(axis=1)[:, np.newaxis]
+    yc = y - y.mean()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = np.sqrt(np.einsum('ij,ij->i', Xc, Xc) * np.dot(yc, yc))
+        r = np.dot(Xc, yc) / denominator
+    r[~(denominator > 0)] = np.nan
+    ## R clamps the result of cor() to [-1,1]
+    return np.clip(r, -1.0, 1.0)
+
+
+def pearson(x, y):
+    return float(pearson_rows(x, y)[0])
+
+
+def brier_rows(X, y):
+    """
+    Mean squared difference of each row of predicted probabilities X from outcomes y
+    """
+    X = np.atleast_2d(X)
+    if len(y) == 0:
+        return np.repeat(np.nan, X.shape[0])
+    return np.mean((X - y)**2, axis=1)
+
+
+def auc_rows(labels, X):
+    """
+    Area under the ROC curve of each row of scores X, computed from the
+    tie-corrected Mann-Whitney U statistic in a single sort of each row.
+
+    As with pROC's roc(direction="auto"), the lower of the two
+    label values is taken to be the controls and the direction
+    of comparison is chosen by comparing the median scores of
+    controls and cases.
+    """
+    X = np.atleast_2d(X)
+    levels = np.unique(labels)
+    if len(levels) < 2:
+        raise ValueError("No %s observation." % ("case" if len(levels) else "control"))
+    controls = labels == levels[0]
+    cases = labels == levels[1]
+    used = controls | cases
+    n_controls = controls.sum()
+    n_cases = cases.sum()
+
+    ranks = rank_average_rows(X[:, used])
+    case_rank_sums = ranks[:, cases[used]].sum(axis=1)
+    result = (case_rank_sums - n_cases * (n_cases + 1) / 2.0) / (n_cases * n_controls)
+
+    flip = np.median(X[:, controls], axis=1) > np.median(X[:, cases], axis=1)
+    return np.where(flip, 1.0 - result, result)
+
+
+def auc(labels, scores):
+    return float(auc_rows(labels, scores)[0])
+
+
+def balanced_accuracy_rows(P, y):
+    """
+    Mean of sensitivity and specificity of each row of 0/1 predictions P
+    """
+    P = np.atleast_2d(P)
+    if not (np.all(np.in1d(P, (0, 1))) and np.all(np.in1d(y, (0, 1)))):
+        raise ValueError("Undiscovered matching error: recode")
+    tp = np.sum((P == 1) & (y == 1), axis=1)
+    tn = np.sum((P == 0) & (y == 0), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 0.5 * tp / np.sum(y == 1) + 0.5 * tn / np.sum(y == 0)
+
+
+def balanced_accuracy(predicted, observed):
+    return float(balanced_accuracy_rows(predicted, observed)[0])
+
+
+def _qnorm(p):
+    """
+    Quantile function of the standard normal distribution, by bisection
+    """
+    lower, upper = -40.0, 40.0
+    for i in range(200):
+        middle = (lower + upper) / 2.0
+        if 0.5 * (1.0 + math.erf(middle / math.sqrt(2.0))) < p:
+            lower = middle
+        else:
+            upper = middle
+    return (lower + upper) / 2.0
+
+
+def concordance_correlation_rows(X, y, conf_level=0.95):
+    """
+    Lin's concordance correlation coefficient of each row of X with y
+    and a confidence interval computed on the inverse hyperbolic tangent
+    transform, matching epiR's epi.ccc(x, y, ci="z-transform").
+
+    Returns a tuple of arrays (estimate, lower, upper).
+    """
+    X = np.atleast_2d(X)
+    k = len(y)
+    zv = _qnorm(1 - ((1 - conf_level) / 2))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xb = X.mean(axis=1)
+        yb = y.mean()
+        sx2 = np.mean((X - xb[:, np.newaxis])**2, axis=1)
+        sy2 = np.mean((y - yb)**2)
+        r = pearson_rows(X, y)
+        sxy = r * np.sqrt(sx2 * sy2)
+        p = 2 * sxy / (sx2 + sy2 + (yb - xb)**2)
+
+        ## location shift relative to the scale
+        u = (yb - xb) / ((sx2 * sy2)**0.25)
+
+        ## variance for the asymptotic normal approximation, Lin (2000) Biometrics 56:324-5
+        sep = np.sqrt(((1 - r**2) * p**2 * (1 - p**2) / r**2
+                       + (2 * p**3 * (1 - p) * u**2 / r)
+                       - 0.5 * p**4 * u**4 / r**2) / (k - 2))
+
+        t = np.log((1 + p) / (1 - p)) / 2
+        set = sep / (1 - p**2)
+        lower = np.tanh(t - zv * set)
+        upper = np.tanh(t + zv * set)
+
+    return p, lower, upper
+
+
+def concordance_correlation(x, y, conf_level=0.95):
+    """
+    Lin's concordance correlation coefficient of x and y, ignoring
+    incomplete pairs as epi.ccc does. Returns a tuple of (estimate, lower, upper).
+    """
+    complete = ~(np.isnan(x) | np.isnan(y))
+    return tuple(float(values[0]) for values in
+                 concordance_correlation_rows(x[complete], y[complete], conf_level))
+
+
+def percent_agreement_rows(P, y):
+    """
+    Percent of categorical values in each row of P that agree with y,
+    compared as integer codes
+    """
+    codes = {}
+    y_codes = np.array([codes.setdefault(value, len(codes)) for value in y], dtype=np.intp)
+    P_codes = np.array([[codes.setdefault(value, len(codes)) for value in row] for row in P],
+                       dtype=np.intp).reshape(-1, len(y_codes))
+    return np.sum(P_codes == y_codes, axis=1) / float(len(y_codes)) * 100.0
+
+
+def percent_agreement(predicted, observed):
+    return float(percent_agreement_rows([predicted], observed)[0])
+
+
+def _error(message):
+    """
+    Return exc_info for a ValueError, to report errors found in batch scoring
+    """
+    try:
+        raise ValueError(message)
+    except ValueError:
+        return sys.exc_info()
+
+
+def _score_batch(submission_paths, observed, score_one, read_aligned, score_aligned):
+    """
+    Score a batch of submissions against one set of observed data.
+
+    For submissions whose IDs are a rearrangement of the observed IDs,
+    read_aligned returns their columns in observed order. These are
+    stacked into matrices, which score_aligned scores all at once. The
+    others, for which read_aligned returns None, go through score_one,
+    as they would when scored individually.
+
+    Returns a list with a pair (result, exc_info) for each submission,
+    where exactly one of the two is None.
+    """
+    results = [None] * len(submission_paths)
+    aligned_rows = []
+    aligned = []
+    for i, submission_path in enumerate(submission_paths):
+        try:
+            predicted = read_submission(submission_path)
+            columns = read_aligned(predicted)
+            if columns is None:
+                results[i] = (score_one(predicted, observed), None)
+            else:
+                aligned_rows.append(i)
+                aligned.append(columns)
+        except Exception:
+            results[i] = (None, sys.exc_info())
+
+    if aligned:
+        matrices = [np.vstack(column) for column in zip(*aligned)]
+        try:
+            batch_results = score_aligned(*matrices)
+        except Exception:
+            batch_results = [sys.exc_info()] * len(aligned_rows)
+        for i, result in zip(aligned_rows, batch_results):
+            results[i] = (None, result) if isinstance(result, tuple) else (result, None)
+
+    return results
+
+
+# Question 1 - Predict change in MMSE at 24 months ------------------------
+
+def Q1_score(predicted, observed):
+    """
+    Correlations of predicted and observed change in MMSE
+
+    predicted: columns projid, delta_MMSE_clin, delta_MMSE_clin_gen
+    observed: columns projid, MMSEbl, MMSEm24
+    """
+    pi, oi = align(predicted['projid'], observed.index)
+
+    delta_mmse = (as_numeric(observed['MMSEm24']) - as_numeric(observed['MMSEbl']))[oi]
+    clin = as_numeric(predicted['delta_MMSE_clin'])[pi]
+    clin_gen = as_numeric(predicted['delta_MMSE_clin_gen'])[pi]
+
+    ## rank the observed values once and reuse for both spearman correlations
+    delta_mmse_ranks = rank_average(delta_mmse)
+
+    result = OrderedDict([
+        ('correlation_pearson_clin', pearson(clin, delta_mmse)),
+        ('correlation_pearson_clin_gen', pearson(clin_gen, delta_mmse)),
+        ('correlation_spearman_clin', pearson(rank_average(clin), delta_mmse_ranks)),
+        ('correlation_spearman_clin_gen', pearson(rank_average(clin_gen), delta_mmse_ranks))])
+
+    ## cor() is NA when values are missing, which propagate as NaN here
+    if any(np.isnan(value) for value in result.values()):
+        raise ValueError("Unable to match subject identifiers")
+
+    return dict(result)
+
+
+def score_q1(submission_path, observed_path):
+    predicted = read_submission(submission_path)
+    observed = read_scoring_data(observed_path)
+    return Q1_score(predicted, observed)
+
+
+def score_q1_batch(submission_paths, observed_path):
+    observed = read_scoring_data(observed_path)
+    delta_mmse = as_numeric(observed['MMSEm24']) - as_numeric(observed['MMSEbl'])
+    delta_mmse_ranks = rank_average(delta_mmse)
+
+    def read_aligned(predicted):
+        order = permutation(predicted['projid'], observed.index)
+        if order is None:
+            return None
+        return (as_numeric(predicted['delta_MMSE_clin'])[order],
+                as_numeric(predicted['delta_MMSE_clin_gen'])[order])
+
+    def score_aligned(clin, clin_gen):
+        columns = OrderedDict([
+            ('correlation_pearson_clin', pearson_rows(clin, delta_mmse)),
+            ('correlation_pearson_clin_gen', pearson_rows(clin_gen, delta_mmse)),
+            ('correlation_spearman_clin', pearson_rows(rank_average_rows(clin), delta_mmse_ranks)),
+            ('correlation_spearman_clin_gen', pearson_rows(rank_average_rows(clin_gen), delta_mmse_ranks))])
+        results = []
+        for i in range(clin.shape[0]):
+            result = {key:float(values[i]) for key, values in columns.iteritems()}
+            if any(np.isnan(value) for value in result.values()):
+                results.append(_error("Unable to match subject identifiers"))
+            else:
+                results.append(result)
+        return results
+
+    return _score_batch(submission_paths, observed,
+                        Q1_score, read_aligned, score_aligned)
+
+
+# Question 2 - Discordance ------------------------------------------------
+
+def _predicted_discordance(predicted):
+    ## according to the AD Challenge wiki, 1=Discordant and 0=Concordant.
+    ## NA stays NA, as in R, so balanced_accuracy rejects it.
+    return np.array([np.nan if value == 'NA' else value.lower() == 'discordant'
+                     for value in predicted['Discordance']],
+                    dtype=np.float64)
+
+
+def Q2_score(predicted, observed):
+    """
+    Brier's score, AUC, Somer's D and balanced accuracy of predicted discordance
+
+    predicted: columns projid, Rank, Confidence, Discordance
+    observed: columns projid, actual_discordance
+    """
+    pi, oi = align(predicted['projid'], observed.index)
+
+    actual_discordance = as_numeric(observed['actual_discordance'])[oi]
+    confidence = as_numeric(predicted['Confidence'])[pi]
+    predicted_discordance = _predicted_discordance(predicted)[pi]
+
+    brier = float(brier_rows(confidence, actual_discordance)[0])
+    if np.isnan(brier):
+        raise ValueError("Unable to match subject identifiers")
+
+    q2_auc = auc(actual_discordance, confidence)
+
+    return {'brier': brier,
+            'auc': q2_auc,
+            'somer': 2 * (q2_auc - 0.5),
+            'accuracy': balanced_accuracy(predicted_discordance, actual_discordance)}
+
+
+def score_q2(submission_path, observed_path):
+    predicted = read_submission(submission_path)
+    observed = read_scoring_data(observed_path)
+    return Q2_score(predicted, observed)
+
+
+def score_q2_batch(submission_paths, observed_path):
+    observed = read_scoring_data(observed_path)
+    actual_discordance = as_numeric(observed['actual_discordance'])
+
+    def read_aligned(predicted):
+        order = permutation(predicted['projid'], observed.index)
+        if order is None:
+            return None
+        confidence = as_numeric(predicted['Confidence'])[order]
+        predicted_discordance = _predicted_discordance(predicted)[order]
+        ## missing confidences and discordances are errors, leave them to Q2_score
+        if np.any(np.isnan(confidence)) or np.any(np.isnan(predicted_discordance)):
+            return None
+        return (confidence, predicted_discordance)
+
+    def score_aligned(confidence, predicted_discordance):
+        brier = brier_rows(confidence, actual_discordance)
+        q2_auc = auc_rows(actual_discordance, confidence)
+        accuracy = balanced_accuracy_rows(predicted_discordance, actual_discordance)
+        results = []
+        for i in range(confidence.shape[0]):
+            if np.isnan(brier[i]):
+                results.append(_error("Unable to match subject identifiers"))
+            else:
+                results.append({'brier': float(brier[i]),
+                                'auc': float(q2_auc[i]),
+                                'somer': float(2 * (q2_auc[i] - 0.5)),
+                                'accuracy': float(accuracy[i])})
+        return results
+
+    return _score_batch(submission_paths, observed,
+                        Q2_score, read_aligned, score_aligned)
+
+
+# Question 3 - Predict change in MMSE from image features -----------------
+
+def _fix_sample_ids(predicted):
+    ## fix for lower case sample IDs ex: "sample8" which should be "Sample8"
+    predicted['ID'] = [id.replace("sample", "Sample") for id in predicted['ID']]
+    return predicted
+
+
+def Q3_score(predicted, observed):
+    """
+    Pearson and concordance correlation of predicted and observed MMSE
+    and percent correct diagnosis
+
+    predicted: columns ID, MMSE, Diagnosis
+    observed: columns Sample.ID, ..., MMSE_Total, ..., V1.Conclusion.Disease_Status, ...
+    """
+    predicted = _fix_sample_ids(predicted)
+
+    pi, oi = align(predicted['ID'], observed.index)
+    if len(pi) != len(observed.ids):
+        raise ValueError("Sample IDs don't match up")
+
+    mmse = as_numeric(predicted['MMSE'])[pi]
+    mmse_total = as_numeric(observed['MMSE_Total'])[oi]
+
+    diagnosis = [predicted['Diagnosis'][i] for i in pi]
+    disease_status = [observed['V1.Conclusion.Disease_Status'][i] for i in oi]
+
+    return {'pearson_mmse': pearson(mmse, mmse_total),
+            'ccc_mmse': concordance_correlation(mmse, mmse_total)[0],
+            'percent_correct_diagnosis': percent_agreement(diagnosis, disease_status)}
+
+
+def score_q3(submission_path, observed_path):
+    predicted = read_submission(submission_path)
+    observed = read_scoring_data(observed_path)
+    return Q3_score(predicted, observed)
+
+
+def score_q3_batch(submission_paths, observed_path):
+    observed = read_scoring_data(observed_path)
+    mmse_total = as_numeric(observed['MMSE_Total'])
+    disease_status = observed['V1.Conclusion.Disease_Status']
+
+    def read_aligned(predicted):
+        predicted = _fix_sample_ids(predicted)
+        order = permutation(predicted['ID'], observed.index)
+        if order is None:
+            return None
+        mmse = as_numeric(predicted['MMSE'])[order]
+        ## epi.ccc drops incomplete pairs, leave those to Q3_score
+        if np.any(np.isnan(mmse)) or np.any(np.isnan(mmse_total)):
+            return None
+        return (mmse, np.array(predicted['Diagnosis'], dtype=object)[order])
+
+    def score_aligned(mmse, diagnosis):
+        pearson_mmse = pearson_rows(mmse, mmse_total)
+        ccc_mmse = concordance_correlation_rows(mmse, mmse_total)[0]
+        percent_correct_diagnosis = percent_agreement_rows(diagnosis, disease_status)
+        return [{'pearson_mmse': float(pearson_mmse[i]),
+                 'ccc_mmse': float(ccc_mmse[i]),
+                 'percent_correct_diagnosis': float(percent_correct_diagnosis[i])}
+                for i in range(mmse.shape[0])]
+
+    return _score_batch(submission_paths, observed,
+                        Q3_score, read_aligned, score_aligned)
+
+
+# Ranking -----------------------------------------------------------------
+
+def mean_rank(data):
+    """
+    Rank submissions on each field, highest score first, then rank the
+    mean of those ranks, as mean_rank in validate_and_score.R does. Ties
+    get their average rank and missing values rank last, like R's rank().
+
+    data holds a sequence of scores for each field. Returns an OrderedDict
+    holding arrays of mean_rank and final_rank.
+    """
+    scores = np.array([np.asarray(values, dtype=np.float64) for values in data.values()])
+    mean_ranks = rank_average_rows(-scores).mean(axis=0)
+    return OrderedDict([('mean_rank', mean_ranks),
+                        ('final_rank', rank_average(mean_ranks))])
@@ -0,0 +1,281 @@
+##
+## Native implementations of the validation functions in
+## validate_and_score.R. Submissions are parsed a line at a
+## time and checked as they're read, so that a file with a
+## malformed row or too many rows is rejected there rather
+## than after being parsed in full; the rows of one with too
+## many are counted from its lines. IDs, and blanks, which R
+## reads as missing only in columns of numbers, are checked
+## once their columns are read.
+##
+## The functions named validate_q[n] have the same signature
+## as their R counterparts: function(submission_path, expected_filename)
+## and return a dict with the same messages. An evaluation is
+## validated by these functions when its entry in
+## ad_challenge_scoring.config_evaluations has
+## 'validation_engine': 'native'. The columns of valid
+## submissions are handed on to native_scoring, so they aren't
+## parsed again when scored.
+############################################################
+
+from collections import OrderedDict
+
+import numpy as np
+
+import metrics
+import native_scoring
+from native_scoring import iter_rows, make_name
+
+
+def invalid(message):
+    return {'valid': False, 'message': message}
+
+
+def _setdiff(values, allowed):
+    """
+    Values not in allowed, in order of first appearance, like R's setdiff()
+    """
+    seen = set()
+    result = []
+    for value in values:
+        if value not in allowed and value not in seen:
+            seen.add(value)
+            result.append(value)
+    return result
+
+
+def _dimensions_message(dim, expected_dim):
+    return "Dimensions of submission (%s) are not as expected (%s)." % (
+        ', '.join(unicode(d) for d in dim),
+        ', '.join(unicode(d) for d in expected_dim))
+
+
+def _count_rows(path):
+    """
+    Count the rows of a file below its header, as its non-blank lines
+    """
+    with open(path, 'rU') as f:
+        return sum(1 for line in f if line.strip()) - 1
+
+
+MISSING_VALUES_MESSAGE = "Data format is invalid: all subjects must be predicted"
+
+## strings that read.table reads as logicals
+R_LOGICAL_STRINGS = ('T', 'F', 'TRUE', 'FALSE', 'true', 'false', 'True', 'False')
+
+
+def _is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def _blanks_are_missing(column):
+    """
+    True if read.table would read the blanks in a column as NA, as it
+    does in a column of numbers or logicals, rather than as empty strings
+    """
+    present = [value for value in column if value != '']
+    return all(_is_number(value) for value in present) or all(value in R_LOGICAL_STRINGS for value in present)
+
+
+def _duplicates(values):
+    """
+    Values that appear more than once, in order of their second appearance
+    """
+    seen = set()
+    result = []
+    for value in values:
+        if value in seen and value not in result:
+            result.append(value)
+        seen.add(value)
+    return result
+
+
+def parse_submission(submission_path, expected, id_column, numeric_columns,
+                     unrecognized_ids_message, duplicated_ids_message, fix_id=None):
+    """
+    Parse a submission, checking the header against the expected format
+    before reading any data, then each row for missing values, then the
+    IDs for any that aren't in the expected set or appear more than once.
+    Blanks are missing values in columns that R would read as numbers.
+
+    Parameters:
+      expected: native_scoring.ScoringData for the expected format
+      id_column: name of the column holding IDs
+      numeric_columns: columns that hold numbers, returned as float arrays
+      unrecognized_ids_message: format for the message about unknown IDs
+      duplicated_ids_message: format for the message about repeated IDs
+      fix_id: function applied to each ID before it's checked
+
+    Returns a pair (result, columns). result is a dict with keys valid and
+    message. If valid, columns is an OrderedDict holding the ID column as
+    a list of strings, numeric columns as float arrays and other columns
+    as lists of strings, otherwise it's None. A numeric column holding
+    something other than numbers is left as strings, as R would read it,
+    and fails when scored.
+    """
+    with metrics.timed('parsing'):
+        return _parse_submission(submission_path, expected, id_column, numeric_columns,
+                                 unrecognized_ids_message, duplicated_ids_message, fix_id)
+
+
+def _parse_submission(submission_path, expected, id_column, numeric_columns,
+                      unrecognized_ids_message, duplicated_ids_message, fix_id=None):
+    rows = iter_rows(submission_path)
+
+    try:
+        header = [make_name(name) for name in next(rows)]
+    except StopIteration:
+        raise ValueError("no lines available in input")
+
+    expected_names = list(expected.keys())
+    if header != expected_names:
+        return invalid("Column names of submission were (%s) but should be (%s)." % (
+            ", ".join(header), ", ".join(expected_names))), None
+
+    n_columns = len(header)
+    n_expected_rows = len(expected[expected_names[0]])
+    id_position = header.index(id_column)
+    values = [[] for name in header]
+    ## whether blanks are missing values depends on the rest of the
+    ## column, so columns holding blanks are checked once they're read
+    blank_columns = set()
+
+    def has_missing_values():
+        return any(_blanks_are_missing(values[i]) for i in blank_columns)
+
+    n_rows = 0
+    for row in rows:
+        n_rows += 1
+        if len(row) > n_columns:
+            raise ValueError("more columns than column names")
+        if len(row) < n_columns or 'NA' in row:
+            return invalid(MISSING_VALUES_MESSAGE), None
+        if '' in row:
+            blank_columns.update(i for i, value in enumerate(row) if value == '')
+
+        if n_rows > n_expected_rows:
+            if has_missing_values():
+                return invalid(MISSING_VALUES_MESSAGE), None
+            ## count the rows, to report the dimensions of the submission,
+            ## from the lines of the file rather than parsing the rest of it
+            n_rows = _count_rows(submission_path)
+            return invalid(_dimensions_message((n_rows, n_columns), (n_expected_rows, n_columns))), None
+
+        if fix_id:
+            row[id_position] = fix_id(row[id_position])
+
+        for column, value in zip(values, row):
+            column.append(value)
+
+    if has_missing_values():
+        return invalid(MISSING_VALUES_MESSAGE), None
+
+    if n_rows != n_expected_rows:
+        return invalid(_dimensions_message((n_rows, n_columns), (n_expected_rows, n_columns))), None
+
+    ## IDs are checked once the whole column is read, since whether
+    ## "0123" is the ID 123, as it is to R, depends on the other IDs.
+    ## Like R, up to six of the offending IDs are reported.
+    ids = native_scoring.id_keys(values[id_position])
+    unrecognized = _setdiff(ids, expected.index)
+    if unrecognized:
+        return invalid(unrecognized_ids_message % (
+            ", ".join(unrecognized[:6]), ", ".join(expected.ids[:6]))), None
+    duplicated = _duplicates(ids)
+    if duplicated:
+        return invalid(duplicated_ids_message % ", ".join(duplicated[:6])), None
+
+    columns = OrderedDict()
+    for name, column in zip(header, values):
+        if name in numeric_columns and name != id_column:
+            try:
+                column = np.array([float(value) for value in column], dtype=np.float64)
+            except ValueError:
+                pass
+        columns[name] = column
+
+    return {'valid': True, 'message': "OK"}, columns
+
+
+PROJID_MESSAGE = "The projid column contained unrecognized identifiers: \"%s\". " \
+                 "The expected identifiers look like these: \"%s\"."
+
+SAMPLE_ID_MESSAGE = "The ID column contained unrecognized sample identifiers: \"%s\". " \
+                    "The expected identifiers look like these: \"%s\"."
+
+DUPLICATED_PROJID_MESSAGE = "The projid column contained duplicated identifiers: \"%s\"."
+
+DUPLICATED_SAMPLE_ID_MESSAGE = "The ID column contained duplicated sample identifiers: \"%s\"."
+
+
+def validate_q1(submission_path, expected_filename):
+    expected = native_scoring.read_scoring_data(expected_filename)
+    result, columns = parse_submission(
+        submission_path, expected,
+        id_column='projid',
+        numeric_columns=('projid', 'delta_MMSE_clin', 'delta_MMSE_clin_gen'),
+        unrecognized_ids_message=PROJID_MESSAGE,
+        duplicated_ids_message=DUPLICATED_PROJID_MESSAGE)
+    if not result['valid']:
+        return result
+
+    ## check for zero variance predictions
+    if not all(len(columns[name]) > 1 and np.var(columns[name]) > 0
+               for name in ('delta_MMSE_clin', 'delta_MMSE_clin_gen')):
+        return invalid(" ".join([
+            "Your prediction has zero variance, which means your submission can't be scored.",
+            "Submissions are scored by correlation with the observed values for change in MMSE, but correlation is",
+            "undefined when either of the correlates has zero variance."]))
+
+    native_scoring.store_parsed_submission(submission_path, columns)
+    return result
+
+
+def validate_q2(submission_path, expected_filename):
+    expected = native_scoring.read_scoring_data(expected_filename)
+    result, columns = parse_submission(
+        submission_path, expected,
+        id_column='projid',
+        numeric_columns=('projid', 'Confidence'),
+        unrecognized_ids_message=PROJID_MESSAGE,
+        duplicated_ids_message=DUPLICATED_PROJID_MESSAGE)
+    if not result['valid']:
+        return result
+
+    ## check that the Discordance column is either Concordant or Discordant
+    allowed_values = ['concordant', 'discordant']
+    unrecognized = _setdiff((value.lower() for value in columns['Discordance']), allowed_values)
+    if unrecognized:
+        return invalid("Unrecognized values in the Discordance column: (%s). Allowed values are (%s)." % (
+            ','.join(unrecognized), ','.join(allowed_values)))
+
+    native_scoring.store_parsed_submission(submission_path, columns)
+    return result
+
+
+def validate_q3(submission_path, expected_filename):
+    expected = native_scoring.read_scoring_data(expected_filename)
+    result, columns = parse_submission(
+        submission_path, expected,
+        id_column='ID',
+        numeric_columns=('MMSE',),
+        unrecognized_ids_message=SAMPLE_ID_MESSAGE,
+        duplicated_ids_message=DUPLICATED_SAMPLE_ID_MESSAGE,
+        ## fix for lower case sample IDs ex: "sample8" which should be "Sample8"
+        fix_id=lambda id: id.replace("sample", "Sample"))
+    if not result['valid']:
+        return result
+
+    ## check that Diagnoses all come from the set of allowed values
+    diagnosis_values = ['CN', 'MCI', 'AD']
+    unrecognized = _setdiff(columns['Diagnosis'], diagnosis_values)
+    if unrecognized:
+        return invalid("Unrecognized values in the Diagnosis column: (%s). Allowed values are (%s)." % (
+            ','.join(unrecognized), ','.join(diagnosis_values)))
+
+    native_scoring.store_parsed_submission(submission_path, columns)
+    return result
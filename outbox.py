@@ -0,0 +1,196 @@
+##
+## A durable outbox for messages to participants and admins
+##
+## Each message is appended to a journal on disk before it's sent,
+## and a delivered mark is appended once it has been sent. Messages
+## are sent by a few threads, no faster than MESSAGES_PER_SECOND, so
+## validation and scoring don't wait on them. Messages that a run
+## didn't get to send, because it died or Synapse refused them, are
+## sent by the next run.
+##
+## Every message has a key. Queueing a message whose key is already
+## in the journal does nothing, so a rerun doesn't queue a message again.
+## Delivery is at least once: a message sent just before a run died,
+## without its delivered mark, is sent again by the next run.
+## Delivered keys are dropped from the journal after the retention
+## period, by which time the statuses the messages were about can no
+## longer be read as they were, see submission_mirror.FULL_REFRESH_SECONDS.
+##
+## Each evaluation queue has its own outbox, guarded by the queue's
+## lock, so runs working on different queues don't share a journal.
+## Outboxes in a process can share a RateLimiter.
+############################################################
+
+import errno
+import json
+import metrics
+import os
+import Queue
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+OUTBOX_DIR = ".outbox"
+
+JOURNAL_FILENAME = "journal.jsonl"
+
+SENDER_THREADS = 4
+
+MESSAGES_PER_SECOND = 2.0
+
+## seconds to remember the keys of delivered messages
+DELIVERED_RETENTION = 24 * 60 * 60
+
+
+class RateLimiter(object):
+    """
+    Spaces out the calls of wait(), from any number of threads, so
+    they return no more than per_second times a second
+    """
+
+    def __init__(self, per_second=MESSAGES_PER_SECOND):
+        self.interval = 1.0 / per_second
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            turn = max(now, self.next_time)
+            self.next_time = turn + self.interval
+        if turn > now:
+            time.sleep(turn - now)
+
+
+class Outbox(object):
+    """
+    Sends messages through a Synapse client, keeping a journal of
+    messages and deliveries in dir
+    """
+
+    def __init__(self, syn, dir=OUTBOX_DIR, threads=SENDER_THREADS, rate_limiter=None,
+                 retention=DELIVERED_RETENTION):
+        self.syn = syn
+        self.path = os.path.join(dir, JOURNAL_FILENAME)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.keys = set()
+
+        try:
+            os.makedirs(dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        for message in self._load():
+            self.queue.put(message)
+        self.journal = open(self.path, 'a')
+
+        self.threads = [threading.Thread(target=self._send_messages, name="outbox-%d" % i)
+                        for i in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _load(self):
+        """
+        Read the journal, returning the messages that haven't been
+        delivered, and rewrite it without the bodies of delivered messages
+        or the keys of those delivered longer ago than the retention period
+        """
+        now = time.time()
+        pending = OrderedDict()
+        delivered = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        ## a partial line written by a run that died
+                        sys.stderr.write("Skipping unreadable line in %s\n" % self.path)
+                        continue
+                    if 'delivered' in entry:
+                        ## marks written before deliveries were timed count from now
+                        delivered[entry['delivered']] = entry.get('at', now)
+                    else:
+                        pending[entry['key']] = entry
+        for key in delivered:
+            pending.pop(key, None)
+        delivered = {key: at for key, at in delivered.iteritems() if now - at <= self.retention}
+        self.keys = set(delivered) | set(pending)
+
+        ## write to a temporary file and rename, so the journal is never partial
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for key in sorted(delivered):
+                    f.write(json.dumps({'delivered': key, 'at': delivered[key]}) + '\n')
+                for message in pending.itervalues():
+                    f.write(json.dumps(message) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_path, self.path)
+        except:
+            os.remove(temp_path)
+            raise
+
+        return pending.values()
+
+    def _append(self, entry):
+        ## callers hold self.lock
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def enqueue(self, key, user_ids, subject, body):
+        """
+        Queue a message for sending. Returns False if a message with
+        the same key was already queued, by this run or an earlier one.
+        """
+        message = {'key': key, 'userIds': list(user_ids), 'subject': subject, 'body': body}
+        with self.lock:
+            if key in self.keys:
+                return False
+            self._append(message)
+            self.keys.add(key)
+        self.queue.put(message)
+        return True
+
+    def _send_messages(self):
+        while True:
+            message = self.queue.get()
+            try:
+                if message is None:
+                    return
+                self.rate_limiter.wait()
+                with metrics.timed('outbox_send'):
+                    response = self.syn.sendMessage(
+                        userIds=message['userIds'],
+                        messageSubject=message['subject'],
+                        messageBody=message['body'])
+                ## a run that dies here sends the message again
+                with self.lock:
+                    self._append({'delivered': message['key'], 'at': time.time()})
+                print "sent message: ", unicode(response).encode('utf-8')
+            except Exception as ex1:
+                ## left undelivered in the journal, to be sent by the next run
+                sys.stderr.write("Error sending message %s: %s\n" % (message['key'], ex1))
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """
+        Wait for queued messages to be sent, then stop the sender threads
+        """
+        self.queue.join()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.journal.close()
@@ -0,0 +1,128 @@
+##
+## A cache of Synapse user profiles, which are needed for the team
+## annotation and for addressing messages to participants.
+##
+## Profiles are held in memory, up to MAX_PROFILES of the most
+## recently used, and on disk as one JSON file per user, so later
+## runs of challenge.py don't fetch them again. Profiles older
+## than TTL_SECONDS are fetched again.
+############################################################
+
+import errno
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from synapseclient.exceptions import SynapseHTTPError
+
+
+CACHE_DIR = ".profile_cache"
+
+TTL_SECONDS = 24 * 60 * 60
+
+MAX_PROFILES = 1000
+
+## the most recently used profiles, as (fetched time, profile), by user ID
+profiles = OrderedDict()
+
+## held while updating profiles, which pipelines share
+profiles_lock = threading.Lock()
+
+
+def _profile_path(user_id):
+    return os.path.join(CACHE_DIR, "%s.json" % user_id)
+
+
+def _remember(user_id, fetched, profile):
+    with profiles_lock:
+        profiles.pop(user_id, None)
+        profiles[user_id] = (fetched, profile)
+        while len(profiles) > MAX_PROFILES:
+            profiles.popitem(last=False)
+
+
+def _load(user_id):
+    """
+    Return a cached profile that hasn't expired, or None
+    """
+    now = time.time()
+    cached = profiles.get(user_id)
+    if cached:
+        fetched, profile = cached
+        if now - fetched < TTL_SECONDS:
+            _remember(user_id, fetched, profile)
+            return profile
+        with profiles_lock:
+            profiles.pop(user_id, None)
+
+    path = _profile_path(user_id)
+    try:
+        fetched = os.path.getmtime(path)
+        if now - fetched >= TTL_SECONDS:
+            return None
+        with open(path) as f:
+            profile = json.load(f)
+    except (IOError, OSError) as err:
+        if err.errno != errno.ENOENT:
+            sys.stderr.write("Can't read cached profile %s: %s\n" % (path, err))
+        return None
+    except ValueError as ex1:
+        sys.stderr.write("Discarding unreadable cached profile %s: %s\n" % (path, ex1))
+        return None
+
+    _remember(user_id, fetched, profile)
+    return profile
+
+
+def _store(user_id, profile):
+    _remember(user_id, time.time(), profile)
+
+    try:
+        os.makedirs(CACHE_DIR)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+    ## write to a temporary file and rename, so readers never see a partial profile
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(profile, f)
+        os.rename(temp_path, _profile_path(user_id))
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def get_user_profile(syn, user_id):
+    """
+    Return the profile of the given user, from the cache if possible
+    """
+    user_id = unicode(user_id)
+    profile = _load(user_id)
+    if profile is None:
+        profile = dict(syn.getUserProfile(user_id))
+        _store(user_id, profile)
+    return profile
+
+
+def prefetch(syn, user_ids):
+    """
+    Fetch the profiles of all the given users that aren't already cached
+    in a single request
+    """
+    missing = sorted(set(unicode(user_id) for user_id in user_ids
+                         if _load(unicode(user_id)) is None))
+    if not missing:
+        return
+    try:
+        response = syn.restPOST("/userProfile", json.dumps({'list': [int(user_id) for user_id in missing]}))
+    except SynapseHTTPError as err:
+        sys.stderr.write("Can't fetch profiles in bulk, they'll be fetched one at a time: %s\n" % err)
+        return
+    for profile in response.get('list', []):
+        _store(unicode(profile['ownerId']), profile)
@@ -0,0 +1,34 @@
+##
+## Accounting of each user's submissions against an evaluation's quota
+##
+## A Quota starts from the number of submissions each user already
+## has counted against the quota, as kept by the mirror's per-user
+## counters, and counts the submissions accepted as a run goes on,
+## so that the quota is enforced in submission order.
+############################################################
+
+
+class Quota(object):
+    """
+    Counts of submissions by user ID, against a limit of None for no quota
+    """
+
+    def __init__(self, counts, limit=None):
+        self.counts = dict(counts)
+        self.limit = limit
+
+    def count(self, user_id):
+        return self.counts.get(user_id, 0)
+
+    def exceeded(self, user_id):
+        """
+        True if the user has no submissions left
+        """
+        return bool(self.limit) and self.count(user_id) >= self.limit
+
+    def add(self, user_id):
+        """
+        Count a submission by the user, returning the user's new count
+        """
+        self.counts[user_id] = self.count(user_id) + 1
+        return self.counts[user_id]
@@ -0,0 +1,61 @@
+##
+## Ranking of scored submissions
+##
+## Submissions are ranked on each field, highest score first, then
+## ranked again by the mean of those ranks, as mean_rank in
+## validate_and_score.R does. Ties get the average of the ranks they
+## span, like R's rank(). Any new score can move every submission's
+## final rank, so the rankings of all submissions are computed at once
+## by native_scoring.mean_rank, and Ranker.changed picks out the ones
+## that need uploading.
+############################################################
+
+from collections import OrderedDict
+
+import numpy as np
+
+import native_scoring
+
+
+class Ranker(object):
+    """
+    Ranks submissions by the mean of their ranks on several fields
+
+    Submissions are identified by a key, usually the submission ID.
+    """
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+        ## scores for each submission, in the order of fields
+        self.scores = OrderedDict()
+
+    def add(self, key, values):
+        """
+        Add a submission, given a dictionary holding a score for each field.
+        Adding a key that's already present replaces its scores. A missing
+        (NaN) score ranks last on its field, like na.last in R's rank().
+        """
+        scores = tuple(float(values[field]) for field in self.fields)
+        self.scores.pop(key, None)
+        self.scores[key] = scores
+
+    def rankings(self):
+        """
+        Return an OrderedDict mapping each key, in the order added, to a
+        tuple (mean_rank, final_rank)
+        """
+        if not self.scores:
+            return OrderedDict()
+        scores = np.array(self.scores.values(), dtype=np.float64)
+        result = native_scoring.mean_rank(OrderedDict(
+            (field, scores[:, i]) for i, field in enumerate(self.fields)))
+        return OrderedDict((key, (float(mean_rank), float(final_rank)))
+                           for key, mean_rank, final_rank in zip(self.scores, result['mean_rank'], result['final_rank']))
+
+    def changed(self, previous):
+        """
+        Return an OrderedDict of the rankings that differ from previous,
+        a dictionary mapping keys to (mean_rank, final_rank) tuples
+        """
+        return OrderedDict((key, ranking) for key, ranking in self.rankings().iteritems()
+                           if previous.get(key) != ranking)
@@ -0,0 +1,197 @@
+##
+## A cache of validation and scoring results, so that a prediction
+## file submitted again, byte for byte, isn't validated or scored again
+##
+## Results are keyed by the SHA-256 of the submission file, the
+## validation or scoring function and the engine that runs it, the
+## content of the file it's checked against (the observed data or the
+## expected format) and the code of the engine, so a change to any of
+## them is never mistaken for a cached result. Only results are cached,
+## not exceptions.
+##
+## Results are held in memory, up to MAX_RESULTS of the most recently
+## used, and on disk as one JSON file per key, so later runs of
+## challenge.py use them too. The least recently used files are evicted
+## when the cache grows beyond MAX_CACHE_BYTES. hits and misses count
+## lookups made by this process.
+############################################################
+
+import errno
+import glob
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+CACHE_DIR = ".result_cache"
+
+MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+MAX_RESULTS = 1000
+
+## the source of each engine, whose content is part of every key
+ENGINE_SOURCES = {
+    'native': ['native_scoring.py', 'native_validation.py'],
+    'R': ['validate_and_score.R'],
+}
+
+## the most recently used results, by key
+results = OrderedDict()
+
+## held while updating results, which pipelines share
+results_lock = threading.Lock()
+
+## hashes of reference files and engine sources, as (version, hash) by path
+file_hashes = {}
+
+hits = 0
+misses = 0
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _stable_file_sha256(path):
+    """
+    The SHA-256 of a file that seldom changes, hashed again only when
+    its modification time or size changes
+    """
+    info = os.stat(path)
+    version = (info.st_mtime, info.st_size)
+    cached = file_hashes.get(path)
+    if cached is None or cached[0] != version:
+        cached = (version, file_sha256(path))
+        file_hashes[path] = cached
+    return cached[1]
+
+
+def key(function, engine, submission_path, reference_path):
+    """
+    The key of the result of a validation or scoring function, run by an
+    engine, of the submission file against the reference file
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(function)
+    sha256.update(engine)
+    sha256.update(file_sha256(submission_path))
+    sha256.update(_stable_file_sha256(reference_path))
+    for source_path in ENGINE_SOURCES.get(engine, []):
+        sha256.update(_stable_file_sha256(source_path))
+    return sha256.hexdigest()
+
+
+def _result_path(key):
+    return os.path.join(CACHE_DIR, "%s.json" % key)
+
+
+def _remember(key, result):
+    with results_lock:
+        results.pop(key, None)
+        results[key] = result
+        while len(results) > MAX_RESULTS:
+            results.popitem(last=False)
+
+
+def get(key):
+    """
+    Return a copy of the cached result for key, or None
+    """
+    global hits, misses
+    result = results.get(key)
+    if result is None:
+        path = _result_path(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            ## mark the entry used, for eviction
+            os.utime(path, None)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                sys.stderr.write("Can't read cached result %s: %s\n" % (path, err))
+        except ValueError as ex1:
+            sys.stderr.write("Discarding unreadable cached result %s: %s\n" % (path, ex1))
+            _remove(path)
+    with results_lock:
+        if result is None:
+            misses += 1
+            return None
+        hits += 1
+    _remember(key, result)
+    return dict(result)
+
+
+def put(key, result):
+    """
+    Cache a copy of a result, a dictionary. Results that can't be written
+    as JSON aren't cached.
+    """
+    try:
+        text = json.dumps(result)
+    except (TypeError, ValueError) as ex1:
+        sys.stderr.write("Not caching result that can't be written as JSON: %s\n" % ex1)
+        return
+    _remember(key, dict(result))
+
+    try:
+        os.makedirs(CACHE_DIR)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+    ## write to a temporary file and rename, so readers never see a partial result
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.rename(temp_path, _result_path(key))
+    except:
+        os.remove(temp_path)
+        raise
+
+    _enforce_size_cap()
+
+
+def hit_rate():
+    """
+    The fraction of lookups by this process found in the cache, or None
+    if there haven't been any
+    """
+    lookups = hits + misses
+    return float(hits) / lookups if lookups else None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def _enforce_size_cap():
+    """
+    Remove the least recently used results until the cache fits in MAX_CACHE_BYTES
+    """
+    entries = []
+    for result_path in glob.glob(os.path.join(CACHE_DIR, "*.json")):
+        try:
+            info = os.stat(result_path)
+            entries.append((info.st_mtime, info.st_size, result_path))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+    total = sum(size for mtime, size, result_path in entries)
+    for mtime, size, result_path in sorted(entries):
+        if total <= MAX_CACHE_BYTES:
+            break
+        _remove(result_path)
+        total -= size
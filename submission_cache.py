@@ -0,0 +1,129 @@
+##
+## A disk cache of parsed submissions, so that a submission file
+## parsed during validation isn't parsed again when it's scored,
+## even by a later run of challenge.py.
+##
+## Entries are NumPy .npz files keyed by submission ID and the MD5
+## of the submission file, so a changed file is never mistaken for
+## a cached one. Entries are evicted once a submission is SCORED or
+## INVALID, and the oldest entries are evicted when the cache grows
+## beyond MAX_CACHE_BYTES.
+############################################################
+
+import errno
+import glob
+import hashlib
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+CACHE_DIR = ".submission_cache"
+
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+
+## name of the array holding column names, in order
+COLUMNS_KEY = "__columns__"
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _artifact_path(submission_id, md5):
+    return os.path.join(CACHE_DIR, "%s.%s.npz" % (submission_id, md5))
+
+
+def save(submission_id, path, columns):
+    """
+    Store the parsed columns of the file at path for the given submission.
+    Numeric columns are stored as float arrays, others as unicode arrays.
+    """
+    try:
+        os.makedirs(CACHE_DIR)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+    arrays = {COLUMNS_KEY: np.array(list(columns.keys()), dtype=np.unicode_)}
+    for i, values in enumerate(columns.values()):
+        if isinstance(values, np.ndarray):
+            arrays['c%d' % i] = values
+        else:
+            arrays['c%d' % i] = np.array(values, dtype=np.unicode_)
+
+    ## write to a temporary file and rename, so readers never see a partial entry
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(temp_path, _artifact_path(submission_id, file_md5(path)))
+    except:
+        os.remove(temp_path)
+        raise
+
+    _enforce_size_cap()
+
+
+def load(submission_id, path):
+    """
+    Return the parsed columns of the file at path for the given
+    submission as an OrderedDict, or None if they aren't cached
+    """
+    artifact_path = _artifact_path(submission_id, file_md5(path))
+    if not os.path.exists(artifact_path):
+        return None
+    try:
+        with np.load(artifact_path) as arrays:
+            columns = OrderedDict()
+            for i, name in enumerate(arrays[COLUMNS_KEY].tolist()):
+                values = arrays['c%d' % i]
+                columns[name] = values if values.dtype.kind == 'f' else values.tolist()
+            return columns
+    except Exception as ex1:
+        sys.stderr.write("Discarding unreadable cache entry %s: %s\n" % (artifact_path, ex1))
+        _remove(artifact_path)
+        return None
+
+
+def evict(submission_id):
+    """
+    Remove all cache entries for a submission
+    """
+    for artifact_path in glob.glob(os.path.join(CACHE_DIR, "%s.*.npz" % submission_id)):
+        _remove(artifact_path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def _enforce_size_cap():
+    """
+    Remove the least recently written entries until the cache fits in MAX_CACHE_BYTES
+    """
+    entries = []
+    for artifact_path in glob.glob(os.path.join(CACHE_DIR, "*.npz")):
+        try:
+            info = os.stat(artifact_path)
+            entries.append((info.st_mtime, info.st_size, artifact_path))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+    total = sum(size for mtime, size, artifact_path in entries)
+    for mtime, size, artifact_path in sorted(entries):
+        if total <= MAX_CACHE_BYTES:
+            break
+        _remove(artifact_path)
+        total -= size
@@ -0,0 +1,399 @@
+##
+## A local mirror of the submissions and statuses of evaluation queues
+##
+## Submissions and their statuses, with etags and annotations, are
+## kept in a SQLite database, indexed by status, user and team, so
+## that listing a queue or counting submissions by user doesn't
+## enumerate the queue on the server. Reads come from the database
+## alone, as of the last refresh, which callers make once per pass
+## over an evaluation. A refresh asks the submission query service
+## which statuses changed since the last one it saw, by modifiedOn,
+## and fetches only those. The query service indexes changes
+## asynchronously, sometimes late, so the RECEIVED bundles, which
+## include every new submission, are also listed from the server and
+## compared with the mirror. The whole queue is fetched again every
+## FULL_REFRESH_SECONDS, which also drops deleted submissions, or when
+## the query service can't be used. Statuses uploaded in batches are
+## marked stale and fetched again, by the next refresh or refresh_stale.
+##
+## Triggers keep a count of each user's submissions in each status,
+## updated in the same transaction as the submissions themselves, so
+## quotas are checked without counting the queue. The counts are
+## checked against the submissions on every full refresh.
+##
+## Each thread has its own connection to the database, which is in
+## WAL mode so that runs working on different evaluations, in threads
+## or processes, can read while another writes. Submissions are
+## fetched before a write transaction begins, so writes are short.
+############################################################
+
+import calendar
+import json
+import sqlite3
+import sys
+import threading
+import time
+import urllib
+from datetime import datetime
+
+from synapseclient import Submission, SubmissionStatus
+from synapseclient.exceptions import SynapseHTTPError
+
+
+MIRROR_PATH = ".submission_mirror.sqlite"
+
+FULL_REFRESH_SECONDS = 24 * 60 * 60
+
+## beyond this many changed statuses, fetching the whole queue in pages
+## is quicker than fetching changed statuses one at a time
+FULL_REFRESH_THRESHOLD = 100
+
+## the query service indexes changes asynchronously, so each query
+## reaches back this far before the latest change it has seen
+QUERY_LAG_MS = 10 * 60 * 1000
+
+QUERY_PAGE_SIZE = 500
+
+## seconds to wait for another connection's write transaction to finish
+BUSY_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bundles (
+    id TEXT PRIMARY KEY,
+    evaluation_id TEXT NOT NULL,
+    user_id TEXT,
+    team TEXT,
+    status TEXT,
+    etag TEXT,
+    created_on TEXT,
+    modified_on INTEGER,
+    stale INTEGER NOT NULL DEFAULT 0,
+    submission TEXT NOT NULL,
+    submission_status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bundles_status ON bundles (evaluation_id, status);
+CREATE INDEX IF NOT EXISTS bundles_user_id ON bundles (evaluation_id, user_id);
+CREATE INDEX IF NOT EXISTS bundles_team ON bundles (evaluation_id, team);
+-- the triggers don't use INSERT OR IGNORE, which would take on the
+-- REPLACE of an INSERT OR REPLACE into bundles
+CREATE TABLE IF NOT EXISTS user_counts (
+    evaluation_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (evaluation_id, user_id, status)
+);
+CREATE TRIGGER IF NOT EXISTS user_counts_insert AFTER INSERT ON bundles BEGIN
+    INSERT INTO user_counts SELECT NEW.evaluation_id, NEW.user_id, NEW.status, 0
+        WHERE NOT EXISTS (SELECT 1 FROM user_counts
+                          WHERE evaluation_id=NEW.evaluation_id AND user_id=NEW.user_id AND status=NEW.status);
+    UPDATE user_counts SET count = count + 1
+        WHERE evaluation_id=NEW.evaluation_id AND user_id=NEW.user_id AND status=NEW.status;
+END;
+CREATE TRIGGER IF NOT EXISTS user_counts_delete AFTER DELETE ON bundles BEGIN
+    UPDATE user_counts SET count = count - 1
+        WHERE evaluation_id=OLD.evaluation_id AND user_id=OLD.user_id AND status=OLD.status;
+END;
+CREATE TRIGGER IF NOT EXISTS user_counts_update AFTER UPDATE OF evaluation_id, user_id, status ON bundles BEGIN
+    UPDATE user_counts SET count = count - 1
+        WHERE evaluation_id=OLD.evaluation_id AND user_id=OLD.user_id AND status=OLD.status;
+    INSERT INTO user_counts SELECT NEW.evaluation_id, NEW.user_id, NEW.status, 0
+        WHERE NOT EXISTS (SELECT 1 FROM user_counts
+                          WHERE evaluation_id=NEW.evaluation_id AND user_id=NEW.user_id AND status=NEW.status);
+    UPDATE user_counts SET count = count + 1
+        WHERE evaluation_id=NEW.evaluation_id AND user_id=NEW.user_id AND status=NEW.status;
+END;
+CREATE TABLE IF NOT EXISTS evaluations (
+    id TEXT PRIMARY KEY,
+    last_modified_on INTEGER,
+    last_full_refresh REAL
+);
+"""
+
+
+def query(syn, query_string, limit=QUERY_PAGE_SIZE):
+    """
+    Run a query against the submission query service, yielding each
+    result as a dictionary from column names to values, which are
+    returned by the service as strings
+    """
+    offset = 0
+    while True:
+        response = syn.restGET('/evaluation/submission/query?query=%s+limit+%d+offset+%d' % (
+            urllib.quote_plus(query_string), limit, offset))
+        headers = response['headers']
+        rows = response.get('rows', [])
+        for row in rows:
+            yield dict(zip(headers, row['values']))
+        offset += len(rows)
+        if not rows or offset >= response['totalNumberOfResults']:
+            break
+
+
+def to_epoch_ms(timestamp):
+    """
+    Convert a Synapse timestamp, like 2014-09-22T21:35:56.880Z, to
+    milliseconds since the epoch, as used by the query service
+    """
+    dt = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+    return calendar.timegm(dt.timetuple()) * 1000 + dt.microsecond // 1000
+
+
+class SubmissionMirror(object):
+    """
+    Mirrors evaluation queues reachable through a Synapse client in a
+    SQLite database at path
+    """
+
+    def __init__(self, syn, path=MIRROR_PATH):
+        self.syn = syn
+        self.path = path
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode = WAL")
+        had_counts = self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='user_counts'").fetchone()
+        self.db.executescript(SCHEMA)
+        ## count submissions mirrored before there were counts
+        if not had_counts:
+            for (evaluation_id,) in self.db.execute("SELECT DISTINCT evaluation_id FROM bundles").fetchall():
+                self.reconcile_counts(evaluation_id)
+
+    @property
+    def db(self):
+        """This thread's connection to the database"""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            ## so that INSERT OR REPLACE fires the delete trigger for the replaced row
+            db.execute("PRAGMA recursive_triggers = ON")
+            self.local.db = db
+            with self.connections_lock:
+                self.connections.append(db)
+        return db
+
+    def close(self):
+        with self.connections_lock:
+            for db in self.connections:
+                db.close()
+            del self.connections[:]
+        self.local = threading.local()
+
+    def _put(self, evaluation_id, submission, status):
+        annotations = status.get('annotations', {})
+        team = None
+        for annotation in annotations.get('stringAnnos', []):
+            if annotation['key'] == 'team':
+                team = annotation['value']
+        if team is None:
+            team = submission.get('submitterAlias', None)
+        self.db.execute(
+            "INSERT OR REPLACE INTO bundles "
+            "(id, evaluation_id, user_id, team, status, etag, created_on, modified_on, submission, submission_status) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (submission.id, unicode(evaluation_id), submission.userId, team,
+             status.status, status.etag, submission.createdOn, to_epoch_ms(status.modifiedOn),
+             json.dumps(submission), json.dumps(status)))
+
+    def _set_last_modified_on(self, evaluation_id, last_modified_on, full_refresh=False):
+        row = self.db.execute("SELECT last_full_refresh FROM evaluations WHERE id=?", (unicode(evaluation_id),)).fetchone()
+        self.db.execute(
+            "INSERT OR REPLACE INTO evaluations (id, last_modified_on, last_full_refresh) VALUES (?, ?, ?)",
+            (unicode(evaluation_id), last_modified_on, time.time() if full_refresh or not row else row[0]))
+
+    def full_refresh(self, evaluation):
+        """
+        Replace the mirror of an evaluation with the queue as it is on the server
+        """
+        bundles = list(self.syn.getSubmissionBundles(evaluation, limit=100))
+        with self.db:
+            self.db.execute("DELETE FROM bundles WHERE evaluation_id=?", (unicode(evaluation.id),))
+            for submission, status in bundles:
+                self._put(evaluation.id, submission, status)
+            last_modified_on = self.db.execute(
+                "SELECT MAX(modified_on) FROM bundles WHERE evaluation_id=?", (unicode(evaluation.id),)).fetchone()[0]
+            self._set_last_modified_on(evaluation.id, last_modified_on, full_refresh=True)
+            self.reconcile_counts(evaluation.id)
+
+    def refresh(self, evaluation):
+        """
+        Fetch the submissions and statuses that changed since the last
+        refresh, as reported by the query service, along with any RECEIVED
+        submissions it hasn't reported yet and any that are no longer RECEIVED
+        """
+        row = self.db.execute(
+            "SELECT last_modified_on, last_full_refresh FROM evaluations WHERE id=?",
+            (unicode(evaluation.id),)).fetchone()
+        if row is None or time.time() - row[1] > FULL_REFRESH_SECONDS:
+            return self.full_refresh(evaluation)
+
+        last_modified_on = row[0] or 0
+        try:
+            results = list(query(self.syn, 'select * from evaluation_%s where modifiedOn > %d' % (
+                evaluation.id, last_modified_on - QUERY_LAG_MS)))
+        except SynapseHTTPError as err:
+            sys.stderr.write("Can't query for changed submissions, fetching them all: %s\n" % err)
+            return self.full_refresh(evaluation)
+
+        ## the query service may index a change later than QUERY_LAG_MS after
+        ## it was made, and so never report it, so the RECEIVED bundles are
+        ## listed from the server itself. Those are few, since they're the
+        ## submissions waiting to be validated.
+        received = list(self.syn.getSubmissionBundles(evaluation, status='RECEIVED'))
+        received_ids = set(status.id for submission, status in received)
+
+        ## skip statuses we already have, including those we stored ourselves
+        mirrored = dict((row[0], row[1:]) for row in self.db.execute(
+            "SELECT id, modified_on, etag, status FROM bundles WHERE evaluation_id=? AND NOT stale",
+            (unicode(evaluation.id),)).fetchall())
+        changed = set(result['objectId'] for result in results
+                      if mirrored.get(result['objectId'], (None,))[0] != long(result['modifiedOn']))
+        changed.update(submission_id for (submission_id,) in self.db.execute(
+            "SELECT id FROM bundles WHERE evaluation_id=? AND stale", (unicode(evaluation.id),)))
+        ## submissions we have as RECEIVED that were since validated, or deleted
+        changed.update(submission_id for submission_id, (modified_on, etag, status) in mirrored.iteritems()
+                       if status == 'RECEIVED' and submission_id not in received_ids)
+        ## the RECEIVED bundles are already fetched, so only those that differ are kept
+        bundles = [(submission, status) for submission, status in received
+                   if mirrored.get(status.id, (None, None))[1] != status.etag]
+        changed -= received_ids
+        if len(changed) + len(bundles) > FULL_REFRESH_THRESHOLD:
+            return self.full_refresh(evaluation)
+
+        fetched, deleted = self._fetch(changed)
+        bundles.extend(fetched)
+
+        with self.db:
+            self.db.executemany("DELETE FROM bundles WHERE id=?", ((submission_id,) for submission_id in deleted))
+            for submission, status in bundles:
+                self._put(evaluation.id, submission, status)
+            self._set_last_modified_on(evaluation.id,
+                max([last_modified_on] + [long(result['modifiedOn']) for result in results]))
+
+    def _fetch(self, submission_ids):
+        """
+        Fetch the given submissions and their statuses, returning a list
+        of (submission, status) bundles and a list of IDs of those deleted
+        """
+        bundles = []
+        deleted = []
+        for submission_id in submission_ids:
+            try:
+                row = self.db.execute("SELECT submission FROM bundles WHERE id=?", (submission_id,)).fetchone()
+                if row:
+                    submission = Submission(**json.loads(row[0]))
+                else:
+                    ## fetch the submission without downloading its file
+                    submission = Submission(**self.syn.restGET(Submission.getURI(submission_id)))
+                bundles.append((submission, self.syn.getSubmissionStatus(submission_id)))
+            except SynapseHTTPError as err:
+                if err.response.status_code != 404:
+                    raise
+                deleted.append(submission_id)
+        return bundles, deleted
+
+    def refresh_stale(self, evaluation):
+        """
+        Fetch only the statuses of an evaluation marked stale, those
+        uploaded since the last refresh
+        """
+        stale = [submission_id for (submission_id,) in self.db.execute(
+            "SELECT id FROM bundles WHERE evaluation_id=? AND stale", (unicode(evaluation.id),))]
+        bundles, deleted = self._fetch(stale)
+        with self.db:
+            self.db.executemany("DELETE FROM bundles WHERE id=?", ((submission_id,) for submission_id in deleted))
+            for submission, status in bundles:
+                self._put(evaluation.id, submission, status)
+
+    def reconcile_counts(self, evaluation_id):
+        """
+        Check the per-user counts of an evaluation against its submissions,
+        rebuilding them if they differ. Returns the number of counts that differed.
+        """
+        evaluation_id = unicode(evaluation_id)
+        counted = set(self.db.execute(
+            "SELECT user_id, status, COUNT(*) FROM bundles WHERE evaluation_id=? GROUP BY user_id, status",
+            (evaluation_id,)))
+        stored = set(self.db.execute(
+            "SELECT user_id, status, count FROM user_counts WHERE evaluation_id=? AND count != 0",
+            (evaluation_id,)))
+        differences = len(counted ^ stored)
+        if differences:
+            sys.stderr.write("Rebuilding %d submission counts for evaluation %s\n" % (differences, evaluation_id))
+            with self.db:
+                self.db.execute("DELETE FROM user_counts WHERE evaluation_id=?", (evaluation_id,))
+                self.db.executemany("INSERT INTO user_counts VALUES (?, ?, ?, ?)",
+                                    ((evaluation_id,) + row for row in counted))
+        return differences
+
+    def invalidate(self, status_ids):
+        """
+        Mark statuses updated on the server, without our knowing their
+        new etags, to be fetched again by the next refresh
+        """
+        with self.db:
+            self.db.executemany("UPDATE bundles SET stale=1 WHERE id=?",
+                                ((status_id,) for status_id in status_ids))
+
+    def put_status(self, status):
+        """
+        Record a status stored to the server, so it needn't be fetched again
+        """
+        row = self.db.execute("SELECT evaluation_id, submission FROM bundles WHERE id=?", (status.id,)).fetchone()
+        if row:
+            with self.db:
+                self._put(row[0], Submission(**json.loads(row[1])), status)
+
+    def bundles(self, evaluation, status=None):
+        """
+        Return (submission, status) pairs for an evaluation, like
+        syn.getSubmissionBundles, optionally only those with the given
+        status, as of the last refresh
+        """
+        sql = "SELECT submission, submission_status FROM bundles WHERE evaluation_id=?"
+        parameters = [unicode(evaluation.id)]
+        if status is not None:
+            sql += " AND status=?"
+            parameters.append(status)
+        sql += " ORDER BY created_on, CAST(id AS INTEGER)"
+        return [(Submission(**json.loads(submission)), SubmissionStatus(**json.loads(submission_status)))
+                for submission, submission_status in self.db.execute(sql, parameters)]
+
+    def modified_on(self, evaluation, status=None):
+        """
+        Return a dictionary from submission ID to the time its status was
+        last modified, in milliseconds since the epoch, for an evaluation,
+        optionally only for statuses with the given status, as of the
+        last refresh
+        """
+        sql = "SELECT id, modified_on FROM bundles WHERE evaluation_id=?"
+        parameters = [unicode(evaluation.id)]
+        if status is not None:
+            sql += " AND status=?"
+            parameters.append(status)
+        return dict(self.db.execute(sql, parameters).fetchall())
+
+    def statuses(self, status_ids):
+        """
+        Return a dictionary from ID to SubmissionStatus for the given
+        statuses, as of the last refresh
+        """
+        return {status_id: SubmissionStatus(**json.loads(submission_status))
+                for status_id in status_ids
+                for (submission_status,) in self.db.execute(
+                    "SELECT submission_status FROM bundles WHERE id=?", (status_id,))}
+
+    def count_by_user(self, evaluation, status=None):
+        """
+        Return a dictionary from user ID to the number of that user's
+        submissions to an evaluation, optionally with the given status,
+        as of the last refresh
+        """
+        sql = "SELECT user_id, SUM(count) FROM user_counts WHERE evaluation_id=?"
+        parameters = [unicode(evaluation.id)]
+        if status is not None:
+            sql += " AND status=?"
+            parameters.append(status)
+        sql += " GROUP BY user_id HAVING SUM(count) > 0"
+        return dict(self.db.execute(sql, parameters).fetchall())
@@ -1,14 +1,29 @@
 import glob
+import json
+import math
 import os
+import shutil
+import socket
+import subprocess
+import sys
 import synapseclient
+import tempfile
+import time
+import urllib
 import uuid
 from synapseclient import Project, File, Folder, Evaluation
+from synapseclient import Submission, SubmissionStatus
+from synapseclient.exceptions import SynapseHTTPError
 from challenge import *
 import challenge
+import claims
+import lock
+import metrics
+import outbox
+import ranking
+import submission_mirror
 from collections import OrderedDict
-
-syn = synapseclient.Synapse()
-syn.login()
+from datetime import timedelta
 
 CLEANUP = True
 
@@ -19,7 +34,372 @@ evaluation = None
 ad_challenge = challenge.ad_challenge_scoring
 
 ## point the scoring code at the test files rather than real challenge assets
-ad_challenge.robjects.r('DATA_DIR <- "test_data"')
+ad_challenge.r_engine().r('DATA_DIR <- "test_data"')
+ad_challenge.native_scoring.DATA_DIR = "test_data"
+
+
+def check_native_scoring(scoring_function, observed, pattern):
+    """
+    Score test submissions in both R and native_scoring and check
+    that they agree, both erroring or both giving the same statistics
+    """
+    native_score_submission = getattr(ad_challenge.native_scoring, scoring_function)
+    r_score_submission = ad_challenge.r_engine().r[scoring_function]
+    for filename in glob.iglob(pattern):
+        try:
+            r_result = ad_challenge.as_dict(r_score_submission(filename, observed))
+        except Exception as ex1:
+            r_result = None
+        try:
+            native_result = native_score_submission(filename, observed)
+        except Exception as ex1:
+            native_result = None
+        print "native", scoring_function, filename, native_result
+        if r_result is None or native_result is None:
+            assert r_result is None and native_result is None, filename
+        else:
+            assert set(r_result.keys()) == set(native_result.keys()), filename
+            for key in r_result:
+                if math.isnan(r_result[key]):
+                    assert math.isnan(native_result[key]), (filename, key)
+                else:
+                    assert abs(r_result[key] - native_result[key]) < 1e-9, (filename, key)
+
+
+def check_native_validation(validation_function, expected_format, pattern):
+    """
+    Validate test submissions in both R and native_validation and check
+    that they agree on validity and messages
+    """
+    native_validate_submission = getattr(ad_challenge.native_validation, validation_function)
+    r_validate_submission = ad_challenge.r_engine().r[validation_function]
+    for filename in glob.iglob(pattern):
+        r_result = ad_challenge.as_dict(r_validate_submission(filename, expected_format))
+        native_result = native_validate_submission(filename, expected_format)
+        print "native", validation_function, filename, native_result
+        assert bool(r_result['valid']) == native_result['valid'], filename
+        assert r_result['message'] == native_result['message'], filename
+
+
+def check_native_mean_rank(corpus_path):
+    """
+    Rank each case in a corpus of scores with mean_rank in R, with
+    native_scoring.mean_rank and with ranking.Ranker, and check that
+    all three give exactly the same mean and final ranks
+    """
+    with open(corpus_path) as f:
+        corpus = json.load(f, object_pairs_hook=OrderedDict)
+    for case in corpus:
+        data = case['data']
+        r_result = ad_challenge.mean_rank(data)
+        native_result = ad_challenge.native_scoring.mean_rank(data)
+        ranker = ranking.Ranker(data.keys())
+        for i in range(len(data.values()[0])):
+            ranker.add(i, {field: values[i] for field, values in data.iteritems()})
+        ranker_result = ranker.rankings().values()
+        print "native mean_rank", case['name']
+        for key in ('mean_rank', 'final_rank'):
+            assert list(r_result[key]) == list(native_result[key]), (case['name'], key)
+        assert zip(r_result['mean_rank'], r_result['final_rank']) == ranker_result, case['name']
+
+
+class FakeEvaluationQueue(object):
+    """
+    Submissions of local files to an evaluation, for challenge.validate and
+    challenge.score, keeping the statuses they store
+    """
+    def __init__(self, evaluation_id, filenames):
+        self.submissions = [Submission(id=unicode(i), evaluationId=unicode(evaluation_id), userId='1',
+                                       entityId='syn1', versionNumber=1, name=filename,
+                                       submitterAlias="Mean Squared Error Blues",
+                                       filePath=os.path.abspath(filename))
+                            for i, filename in enumerate(filenames)]
+        self.statuses = {submission.id: SubmissionStatus(id=submission.id, etag=unicode(uuid.uuid4()),
+                                                         status='RECEIVED', annotations={})
+                         for submission in self.submissions}
+
+    def getSubmissionBundles(self, evaluation, status=None):
+        return [(submission, SubmissionStatus(**self.statuses[submission.id])) for submission in self.submissions
+                if status in (None, self.statuses[submission.id].status)]
+
+    def getSubmission(self, submission):
+        return submission
+
+    def store(self, status):
+        self.statuses[status.id] = status
+        return status
+
+    def restPUT(self, uri, body):
+        for status in json.loads(body)['statuses']:
+            self.statuses[status['id']] = SubmissionStatus(**status)
+        return {'nextUploadToken': 'token'}
+
+
+def check_native_metrics(evaluation_id, pattern):
+    """
+    Validate and score test submissions with the native engines through
+    challenge.validate and challenge.score, and check that the timings of
+    their stages are written as JSON lines and added to a Prometheus textfile
+    """
+    challenge_config = ad_challenge.config_evaluations_map[evaluation_id]
+    native_config = dict(challenge_config, validation_engine='native', scoring_engine='native')
+    queue = FakeEvaluationQueue(evaluation_id, sorted(glob.glob(pattern)))
+    evaluation = Evaluation(id=unicode(evaluation_id), name="metrics", contentSource='syn1')
+    metrics_dir = tempfile.mkdtemp()
+    previous_syn = challenge.syn
+    try:
+        ad_challenge.config_evaluations_map[evaluation_id] = native_config
+        challenge.syn = queue
+        metrics.drain()
+        validate(evaluation, validation_func=ad_challenge.validate_submission, config=native_config)
+        score(evaluation, batch_scoring_func=ad_challenge.score_submission_batch, config=native_config)
+        metrics.write(metrics_dir)
+
+        with open(os.path.join(metrics_dir, metrics.JSON_LINES_FILENAME)) as f:
+            lines = [json.loads(line) for line in f]
+        assert set(line['submission'] for line in lines if line['type'] == 'submission') == \
+            set(submission.id for submission in queue.submissions)
+        run = [line for line in lines if line['type'] == 'run']
+        assert len(run) == 1 and 'getSubmission' in run[0]['stages'], run
+        with open(os.path.join(metrics_dir, metrics.PROMETHEUS_FILENAME)) as f:
+            prometheus = f.read()
+        for stage in run[0]['stages']:
+            assert 'challenge_stage_seconds_count{stage="%s"}' % stage in prometheus, stage
+
+        ## the Prometheus histograms are cumulative across writes
+        written = metrics.read_prometheus(os.path.join(metrics_dir, metrics.PROMETHEUS_FILENAME))
+        metrics.record('getSubmission', 0.5)
+        metrics.write(metrics_dir)
+        totals = metrics.read_prometheus(os.path.join(metrics_dir, metrics.PROMETHEUS_FILENAME))
+        assert totals['getSubmission']['count'] == written['getSubmission']['count'] + 1
+        assert totals['getSubmission']['buckets'][-1] == totals['getSubmission']['count']
+        assert set(totals) == set(written)
+        print "native metrics checks passed"
+    finally:
+        ad_challenge.config_evaluations_map[evaluation_id] = challenge_config
+        challenge.syn = previous_syn
+        shutil.rmtree(metrics_dir)
+
+
+def check_lock():
+    """
+    Check that a lease lock excludes other holders while its holder makes
+    progress, is taken over from a dead owner, and is given up by a holder
+    that stops making progress, which then finds it lost
+    """
+    lock_dir = tempfile.mkdtemp()
+    try:
+        held = lock.Lock('check', dir=lock_dir, lease=timedelta(seconds=2), stall=timedelta(seconds=1))
+        other = lock.Lock('check', dir=lock_dir, lease=timedelta(seconds=2))
+        assert held.acquire()
+        assert not other.acquire(), "acquired a held lock"
+        assert other.owner()['token'] == held.token
+        assert not other.acquire(timeout=1.5), "acquired a held lock, waiting"
+        assert lock.metrics[-1]['contended']
+
+        ## lease and stall are both up, so the lease is no longer renewed
+        time.sleep(3)
+        assert other.acquire(), "didn't take over a stalled lock"
+        assert lock.metrics[-1]['taken_over'] == "lease expired"
+        try:
+            held.progress()
+            assert False, "holder of a lost lock went on"
+        except lock.LockLostException:
+            pass
+        held.release()
+        assert other.owner()['token'] == other.token, "releasing a lost lock released the new owner's"
+        other.release()
+        assert other.owner() is None
+
+        ## a lease held by a process that has exited
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        with open(os.path.join(lock_dir, 'check.lease'), 'w') as f:
+            json.dump({'pid': dead.pid, 'hostname': socket.gethostname(), 'token': 'dead',
+                       'acquired': time.time(), 'expires': time.time() + 60}, f)
+        assert other.acquire(), "didn't take over a dead owner's lock"
+        assert lock.metrics[-1]['taken_over'] == "owner is dead"
+        other.release()
+        print "lock checks passed"
+    finally:
+        shutil.rmtree(lock_dir)
+
+
+def check_claims():
+    """
+    Check that submissions claimed by one worker can't be claimed by
+    another until they're released, and that a user's submissions are
+    claimed together
+    """
+    claims_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(claims_dir, 'claims.sqlite')
+        first = claims.SQLiteClaimStore(path)
+        second = claims.SQLiteClaimStore(path)
+        statuses = [SubmissionStatus(id='1', etag='e', status='RECEIVED')]
+        assert first.claim_statuses('1/u1', statuses) is statuses
+        assert first.claim_statuses('1/u1', statuses) is statuses, "a worker can claim what it holds"
+        assert second.claim_statuses('1/u1', statuses) is None, "claimed a user held by another worker"
+        first.release('1/u1')
+        assert second.claim_statuses('1/u1', statuses) is statuses, "couldn't claim a released user"
+        second.close()
+        assert first.claim_statuses('1/u1', statuses) is statuses, "closing a store didn't release its claims"
+        first.close()
+    finally:
+        shutil.rmtree(claims_dir)
+
+    syn = FakeStatuses()
+    first = claims.StatusClaimStore(syn)
+    second = claims.StatusClaimStore(syn)
+    statuses = [syn.store(SubmissionStatus(id=id, status='RECEIVED')) for id in ('1', '2')]
+    held = first.claim_statuses('1/u1', statuses[1:])
+    assert held, "couldn't claim an unclaimed submission"
+    assert second.claim_statuses('1/u1', statuses) is None, "claimed a submission held by another worker"
+    assert syn.getSubmissionStatus('1').etag != statuses[0].etag, "a failed claim wasn't given up"
+    released = syn.store(claims.remove_claim(held[0]))
+    assert second.claim_statuses('1/u1', [syn.getSubmissionStatus('1'), released]), \
+        "couldn't claim submissions once their claims were removed"
+    print "claims checks passed"
+
+
+class FakeStatuses(object):
+    """Stores submission statuses, failing those stored with an old etag"""
+    def __init__(self):
+        self.statuses = {}
+
+    def store(self, status):
+        stored = self.statuses.get(status.id)
+        if stored and stored.etag != status.get('etag'):
+            raise SynapseHTTPError(response=FakeResponse(412))
+        self.statuses[status.id] = SubmissionStatus(**json.loads(json.dumps(dict(status, etag=unicode(uuid.uuid4())))))
+        return self.getSubmissionStatus(status.id)
+
+    def getSubmissionStatus(self, id):
+        return SubmissionStatus(**json.loads(json.dumps(self.statuses[id])))
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeMessages(object):
+    """Records messages sent, failing them while fail is set"""
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+
+    def sendMessage(self, userIds, messageSubject, messageBody):
+        if self.fail:
+            raise IOError("can't send messages")
+        self.sent.append(messageSubject)
+        return {'subject': messageSubject}
+
+
+def check_outbox():
+    """
+    Check that messages an outbox couldn't send are replayed by the next
+    one, and that no message is sent twice
+    """
+    outbox_dir = tempfile.mkdtemp()
+    try:
+        failing = FakeMessages(fail=True)
+        first = outbox.Outbox(failing, dir=outbox_dir)
+        assert first.enqueue('a', [1], 'subject a', 'body')
+        assert not first.enqueue('a', [1], 'subject a', 'body')
+        first.close()
+
+        working = FakeMessages()
+        second = outbox.Outbox(working, dir=outbox_dir)
+        second.close()
+        assert working.sent == ['subject a'], working.sent
+
+        third = outbox.Outbox(working, dir=outbox_dir)
+        assert not third.enqueue('a', [1], 'subject a', 'body'), "queued a delivered message again"
+        assert third.enqueue('b', [1], 'subject b', 'body')
+        third.close()
+        assert working.sent == ['subject a', 'subject b'], working.sent
+        print "outbox checks passed"
+    finally:
+        shutil.rmtree(outbox_dir)
+
+
+class FakeQueue(object):
+    """
+    An evaluation queue for a SubmissionMirror, whose query service only
+    reports the changes listed in indexed
+    """
+    def __init__(self):
+        self.submissions = {}
+        self.statuses = {}
+        self.indexed = set()
+
+    def submit(self, id, user_id, modified_on, status='RECEIVED', indexed=True):
+        self.submissions[id] = dict(id=id, evaluationId='1', userId=user_id, entityId='syn1',
+                                    versionNumber=1, name=id, createdOn=modified_on)
+        self.update(id, status, modified_on, indexed)
+
+    def update(self, id, status, modified_on, indexed=True):
+        self.statuses[id] = dict(id=id, etag=unicode(uuid.uuid4()), status=status,
+                                 modifiedOn=modified_on, annotations={})
+        if indexed:
+            self.indexed.add(id)
+
+    def getSubmissionBundles(self, evaluation, status=None, limit=20):
+        return [(Submission(**self.submissions[id]), SubmissionStatus(**self.statuses[id]))
+                for id in sorted(self.submissions) if status in (None, self.statuses[id]['status'])]
+
+    def getSubmissionStatus(self, id):
+        return SubmissionStatus(**self.statuses[id])
+
+    def restGET(self, uri):
+        if not uri.startswith('/evaluation/submission/query'):
+            return self.submissions[uri.split('/')[-1]]
+        query = urllib.unquote_plus(uri.split('query=')[1].split('+limit')[0])
+        since = long(query.split('> ')[1])
+        rows = [{'values': [id, unicode(submission_mirror.to_epoch_ms(self.statuses[id]['modifiedOn']))]}
+                for id in sorted(self.indexed)
+                if submission_mirror.to_epoch_ms(self.statuses[id]['modifiedOn']) > since]
+        return {'headers': ['objectId', 'modifiedOn'], 'rows': rows, 'totalNumberOfResults': len(rows)}
+
+
+def check_submission_mirror():
+    """
+    Check that a mirror picks up changed statuses reported by the query
+    service, validated submissions, new ones it hasn't reported, and
+    statuses marked stale, but only when refreshed
+    """
+    mirror_dir = tempfile.mkdtemp()
+    try:
+        queue = FakeQueue()
+        queue.submit('1', 'u1', '2016-01-01T00:00:00.000Z')
+        queue.submit('2', 'u2', '2016-01-01T00:01:00.000Z', status='VALIDATED')
+        evaluation = Evaluation(id='1', name='mirrored', contentSource='syn1')
+        mirror = submission_mirror.SubmissionMirror(queue, path=os.path.join(mirror_dir, 'mirror.sqlite'))
+        mirror.refresh(evaluation)
+        assert [submission.id for submission, status in mirror.bundles(evaluation)] == ['1', '2']
+
+        queue.update('1', 'VALIDATED', '2016-01-02T00:00:00.000Z')
+        queue.update('2', 'SCORED', '2016-01-02T00:01:00.000Z')
+        ## indexed by the query service too late to be reported
+        queue.submit('3', 'u1', '2016-01-01T00:02:00.000Z', indexed=False)
+        assert len(mirror.bundles(evaluation)) == 2, "read from the server without a refresh"
+        mirror.refresh(evaluation)
+        bundles = mirror.bundles(evaluation)
+        assert [(submission.id, status.status) for submission, status in bundles] == \
+            [('1', 'VALIDATED'), ('2', 'SCORED'), ('3', 'RECEIVED')], bundles
+        assert mirror.count_by_user(evaluation) == {'u1': 2, 'u2': 1}
+        assert mirror.reconcile_counts(evaluation.id) == 0
+
+        ## an uploaded status is fetched again on its own
+        queue.update('2', 'SCORED', '2016-01-03T00:00:00.000Z', indexed=False)
+        mirror.invalidate(['2'])
+        mirror.refresh_stale(evaluation)
+        assert mirror.statuses(['2'])['2'].etag == queue.statuses['2']['etag']
+        mirror.close()
+        print "submission mirror checks passed"
+    finally:
+        shutil.rmtree(mirror_dir)
 
 
 WIKI_TEMPLATE = """\
@@ -35,6 +415,30 @@ ${{supertable?path=%2Fevaluation%2Fsubmission%2Fquery%3Fquery%3Dselect+%2A+from+
 
 """
 
+## checks that run locally, without logging in to Synapse. Given
+## --offline, test.py stops after these.
+check_lock()
+check_claims()
+check_outbox()
+check_submission_mirror()
+check_native_metrics(ad_challenge.config_evaluations[0]['id'], "test_data/q1.0*")
+check_native_mean_rank("test_data/mean_rank.corpus.json")
+
+## test_data/native.* are cases for the native code that aren't
+## submitted to the test evaluations
+for question, observed, expected_format in (('q1', 'q1.rosmap.csv', 'q1.txt'),
+                                            ('q2', 'q2.observed.txt', 'q2.txt'),
+                                            ('q3', 'q3.observed.csv', 'q3.txt')):
+    for pattern in ("test_data/%s.0*" % question, "test_data/native.%s.*" % question):
+        check_native_scoring('score_' + question, observed, pattern)
+        check_native_validation('validate_' + question, expected_format, pattern)
+
+if '--offline' in sys.argv[1:]:
+    sys.exit(0)
+
+syn = synapseclient.Synapse()
+syn.login()
+
 try:
     challenge.syn = syn
 